@@ -0,0 +1,2 @@
+# Benchmarks of the KPI pipeline on synthetic SAP exports, without the P: share and without SAP:
+#   python -m benchmarks.run_benchmarks --sizes 10000 100000 1000000
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import re
+import threading
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+
+# Pole klucza, po którym py_rfc_methods odpytuje tabelę
+KEY_FIELDS = {
+    "VBAP": "VBELN",
+    "VBBE": "VBELN",
+    "EKKN": "EBELN",
+}
+
+# Długości pól w SAP (DDIC) - RFC_READ_TABLE zwraca wiersze o stałej szerokości
+FIELD_LENGTHS = {
+    "VBELN": 10,
+    "POSNR": 6,
+    "WERKS": 4,
+    "SOBKZ": 1,
+    "EBELN": 10,
+    "EBELP": 5,
+    "VBELP": 6,
+}
+
+_LITERAL = r"'((?:[^']|'')*)'"
+_BETWEEN = re.compile(rf"BETWEEN\s+{_LITERAL}\s+AND\s+{_LITERAL}")
+
+
+class FakeSapSystem:
+    """
+    In-process stand-in for an SAP system answering RFC_READ_TABLE for VBAP / EKKN / VBBE.
+
+    Tables are DataFrames of string columns (see benchmarks.synthetic_exports.generate_exports).
+    Every call sleeps `latency` seconds, like a round trip to P11. Plug it in with
+    sap_conn.set_connection_factory(system.connect).
+    """
+
+    def __init__(self, tables: Dict[str, pd.DataFrame], latency: float = 0.0):
+        self.latency = latency
+        self.tables: Dict[str, pd.DataFrame] = {}
+        self.sorted_keys: Dict[str, np.ndarray] = {}
+        for table, df in tables.items():
+            df = df.sort_values(KEY_FIELDS[table], kind="stable").reset_index(drop=True).astype(str)
+            self.tables[table] = df
+            self.sorted_keys[table] = df[KEY_FIELDS[table]].to_numpy()
+
+        self.calls = 0
+        self.rows_returned = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def connect(self, **params: Any) -> "FakeRfcConnection":
+        with self._lock:
+            self.connections += 1
+        return FakeRfcConnection(self)
+
+    def select(self, table: str, where: str) -> pd.DataFrame:
+        """
+        Rows matching a WHERE built by sap_rtab.build_key_where ("KEY IN (...)", "KEY = ...",
+        "KEY BETWEEN ... AND ..." joined with OR). Empty WHERE returns the whole table.
+        """
+        df = self.tables.get(table)
+        if df is None:
+            raise ValueError(f"Table {table} is not available in the fake SAP system")
+        if not where.strip():
+            return df
+
+        keys = self.sorted_keys[table]
+        positions: List[np.ndarray] = []
+        for low, high in _BETWEEN.findall(where):
+            start = np.searchsorted(keys, low.replace("''", "'"), side="left")
+            stop = np.searchsorted(keys, high.replace("''", "'"), side="right")
+            positions.append(np.arange(start, stop))
+
+        literals = np.array([value.replace("''", "'") for value in re.findall(_LITERAL, _BETWEEN.sub("", where))])
+        if len(literals):
+            start = np.searchsorted(keys, literals, side="left")
+            stop = np.searchsorted(keys, literals, side="right")
+            positions.extend(np.arange(a, b) for a, b in zip(start, stop) if b > a)
+
+        if not positions:
+            return df.iloc[0:0]
+        return df.iloc[np.unique(np.concatenate(positions))]
+
+
+class FakeRfcConnection:
+    """
+    pyrfc.Connection replacement - only call("RFC_READ_TABLE", ...) and close() are used by sap_rtab / sap_conn.
+    """
+
+    def __init__(self, system: FakeSapSystem):
+        self.system = system
+        self.alive = True
+
+    def call(self, func_name: str, QUERY_TABLE: str, DELIMITER: str = "", FIELDS=(), OPTIONS=(),
+             ROWCOUNT: int = 0, ROWSKIPS: int = 0, **params: Any) -> Dict[str, Any]:
+        if func_name != "RFC_READ_TABLE":
+            raise NotImplementedError(f"Fake RFC connection does not implement {func_name}")
+        if not self.alive:
+            raise RuntimeError("Fake RFC connection is closed")
+
+        if self.system.latency:
+            time.sleep(self.system.latency)
+
+        # OPTIONS to WHERE pocięty na linie po 72 znaki - sklejenie spacją jak w SAP
+        where = " ".join(option["TEXT"] for option in OPTIONS)
+        rows = self.system.select(QUERY_TABLE, where)
+        if ROWSKIPS:
+            rows = rows.iloc[ROWSKIPS:]
+        if ROWCOUNT:
+            rows = rows.iloc[:ROWCOUNT]
+
+        fields = [f["FIELDNAME"] for f in FIELDS] or list(rows.columns)
+        field_meta = []
+        offset = 0
+        for field in fields:
+            length = FIELD_LENGTHS.get(field, 20)
+            field_meta.append({"FIELDNAME": field, "OFFSET": f"{offset:06d}", "LENGTH": f"{length:06d}"})
+            offset += length + len(DELIMITER)
+
+        wa = None
+        for field in fields:
+            column = rows[field].str.ljust(FIELD_LENGTHS.get(field, 20)) if field in rows.columns \
+                else pd.Series(" " * FIELD_LENGTHS.get(field, 20), index=rows.index)
+            wa = column if wa is None else wa + DELIMITER + column
+
+        with self.system._lock:
+            self.system.calls += 1
+            self.system.rows_returned += len(rows)
+
+        data = [] if wa is None else [{"WA": value.rstrip()} for value in wa]
+        return {"FIELDS": field_meta, "DATA": data}
+
+    def close(self) -> None:
+        self.alive = False
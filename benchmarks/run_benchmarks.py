@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scripted benchmarks of the KPI pipeline (run_departments -> kpis_loop) on synthetic SAP exports,
+with benchmarks.fake_rfc in place of P11. Time and peak traced memory are reported per stage
+(the KPI_STAGES records of log_utils.StageTimer).
+
+    python -m benchmarks.run_benchmarks                      # 10k, 100k and 1M ZSDKAP rows, all departments
+    python -m benchmarks.run_benchmarks --sizes 10000 --latency 0.2 --repeat 2 --json bench.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, List
+
+WORK_DIR = Path(os.environ.get("PPS_KPI_BENCHMARK_DIR", Path(tempfile.gettempdir()) / "pps_kpi_benchmark"))
+
+# Cache i historia KPI benchmarku osobno od produkcyjnych - muszą być ustawione przed importem cache_config.
+# Cache RFC wyłączony: każde uruchomienie odpytuje (fałszywy) SAP, jak pierwszy przebieg dnia.
+os.environ["PPS_KPI_CACHE_DIR"] = str(WORK_DIR / "cache")
+os.environ["PPS_KPI_STORE"] = str(WORK_DIR / "kpi_history.sqlite")
+os.environ["PPS_KPI_RFC_CACHE"] = "0"
+
+import calculate_KPIs  # noqa: E402
+from benchmarks.fake_rfc import FakeSapSystem  # noqa: E402
+from benchmarks.synthetic_exports import generate_exports  # noqa: E402
+from log_utils import stage_timer  # noqa: E402
+from output_sinks import DETAIL_OUTPUT_MODES  # noqa: E402
+from sap_conn import set_connection_factory  # noqa: E402
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+
+
+class StageCollector(logging.Handler):
+    """
+    Collects the JSON records logged by StageTimer.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.records: List[Dict[str, Any]] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.records.append(json.loads(record.getMessage()))
+        except ValueError:
+            pass
+
+
+def summarize_stages(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    One row per stage (excel_read per source): number of records, total seconds, max peak_mb, total rows.
+    """
+    summary: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        name = record['stage'] + (f"[{record['source']}]" if 'source' in record else "")
+        row = summary.setdefault(name, {'stage': name, 'count': 0, 'seconds': 0.0, 'peak_mb': None, 'rows': None})
+        row['count'] += 1
+        row['seconds'] += record.get('seconds', 0.0)
+        if 'peak_mb' in record:
+            row['peak_mb'] = max(row['peak_mb'] or 0.0, record['peak_mb'])
+        if 'rows' in record:
+            row['rows'] = (row['rows'] or 0) + record['rows']
+        if record.get('status', 'ok') != 'ok':
+            row['status'] = record['status']
+
+    return list(summary.values())
+
+
+def print_summary(title: str, stages: List[Dict[str, Any]]) -> None:
+    print(f"\n== {title}")
+    print(f"{'stage':<28}{'count':>7}{'seconds':>11}{'peak MB':>10}{'rows':>12}")
+    for row in stages:
+        peak = f"{row['peak_mb']:.1f}" if row['peak_mb'] is not None else "-"
+        rows = f"{row['rows']}" if row['rows'] is not None else "-"
+        status = f"  {row['status']}" if 'status' in row else ""
+        print(f"{row['stage']:<28}{row['count']:>7}{row['seconds']:>11.3f}{peak:>10}{rows:>12}{status}")
+
+
+def run_pipeline(departments: List[str], trace_memory: bool) -> Dict[str, Any]:
+    """
+    One run_departments over the exports in calculate_KPIs.SAP_EXPORTS_DIR.
+    """
+    collector = StageCollector()
+    stage_logger = logging.getLogger("KPI_STAGES")
+    stage_logger.addHandler(collector)
+
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        # Cały przebieg jako jeden etap - jego peak_mb obejmuje szczyty wszystkich etapów w środku
+        with stage_timer(stage_logger, 'benchmark_run', departments='+'.join(departments)) as timer:
+            calculate_KPIs.run_departments(departments)
+    except Exception as e:
+        # Szczegóły wypisał już kpis_loop, przebieg zapisany ze statusem error
+        print(f"Benchmark run failed: {e!r}")
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        stage_logger.removeHandler(collector)
+
+    return {
+        'status': timer.fields['status'],
+        'seconds': timer.fields['seconds'],
+        'peak_mb': timer.fields.get('peak_mb'),
+        'stages': summarize_stages([r for r in collector.records if r['stage'] != 'benchmark_run']),
+        'records': collector.records,
+    }
+
+
+def run_benchmark(rows: int, departments: List[str], args: argparse.Namespace) -> List[Dict[str, Any]]:
+    size_dir = WORK_DIR / f"zsdkap_{rows}"
+    exports_dir = size_dir / "exports"
+    output_dir = size_dir / "output"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    start = time.perf_counter()
+    tables = generate_exports(str(exports_dir), rows, seed=args.seed,
+                              departments={d: calculate_KPIs.DEPARTMENTS[d] for d in departments})
+    print(f"Synthetic exports ({rows} ZSDKAP rows) generated in {time.perf_counter() - start:.1f} s: {exports_dir}")
+
+    sap_system = FakeSapSystem(tables, latency=args.latency)
+    set_connection_factory(sap_system.connect)
+    calculate_KPIs.SAP_EXPORTS_DIR = str(exports_dir)
+    calculate_KPIs.OUTPUT_FILE_PATH = str(output_dir)
+
+    results = []
+    try:
+        # Pierwszy przebieg czyta xlsx, kolejne (--repeat) już z lokalnego cache Excela
+        for run in range(1, args.repeat + 1):
+            calls_before, rows_before = sap_system.calls, sap_system.rows_returned
+            result = run_pipeline(departments, trace_memory=not args.no_memory)
+            result.update(zsdkap_rows=rows, run=run, departments=departments,
+                          rfc_calls=sap_system.calls - calls_before,
+                          rfc_rows=sap_system.rows_returned - rows_before)
+            peak = f", peak {result['peak_mb']} MB" if result['peak_mb'] is not None else ""
+            print_summary(f"{rows} ZSDKAP rows, run {run}: {result['seconds']} s{peak}, "
+                          f"RFC {result['rfc_calls']} calls / {result['rfc_rows']} rows, {result['status']}",
+                          result['stages'])
+            results.append(result)
+    finally:
+        set_connection_factory(None)
+        if not args.keep:
+            shutil.rmtree(size_dir, ignore_errors=True)
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="PPS KPI benchmarks on synthetic SAP exports")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help="ZSDKAP order rows per benchmark")
+    parser.add_argument('--departments', nargs='*', default=['all'], help="as in calculate_KPIs (default: all)")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per fake RFC call (default: 0.05)")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per size on the same exports")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compact', action='store_true', help="as calculate_KPIs --compact")
+    parser.add_argument('--line-workers', type=int, default=calculate_KPIs.LINE_WORKERS,
+                        help="as calculate_KPIs --line-workers (stages inside workers are not collected)")
+    parser.add_argument('--detail-output', choices=DETAIL_OUTPUT_MODES, default=calculate_KPIs.DETAIL_OUTPUT)
+    parser.add_argument('--incremental', action='store_true',
+                        help="as calculate_KPIs --incremental (with --repeat, later runs see unchanged inputs)")
+    parser.add_argument('--no-memory', action='store_true', help="no tracemalloc (timings without its overhead)")
+    parser.add_argument('--json', metavar='PATH', help="dump results (with the raw stage records) to a JSON file")
+    parser.add_argument('--keep', action='store_true', help=f"keep generated exports and detail output in {WORK_DIR}")
+    args = parser.parse_args()
+
+    calculate_KPIs.WRITE_EXCEL = False
+    calculate_KPIs.PAUSE_ON_ERROR = False
+    calculate_KPIs.COMPACT_DTYPES = args.compact
+    calculate_KPIs.LINE_WORKERS = args.line_workers
+    calculate_KPIs.DETAIL_OUTPUT = args.detail_output
+    calculate_KPIs.INCREMENTAL = args.incremental
+
+    departments = calculate_KPIs.parse_departments(args.departments)
+    results = []
+    for rows in args.sizes:
+        results.extend(run_benchmark(rows, departments, args))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, default=str)
+        print(f"\nResults saved to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import argparse
+import shutil
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from helper_functions import generate_zsdkap_filename
+from maps import (
+    zsdkap_new_columns_names, zsbe_new_columns_names, mb5td_new_columns_names, mb52_new_columns_names,
+    zkbp1_new_columns_names, production_site_map,
+)
+
+# Zakłady dostarczające z VBAP - wszystkie mają trasę w shipping_logic (albo są zakładem produkcji)
+DELIVERY_PLANTS = np.array(["2101", "0301", "1201", "3701"])
+
+# Materiały spoza linii (inne kontrolery / opisy) - odfiltrowywane przy wczytywaniu
+NOISE_CONTROLLERS = ("XXA", "XXB", "L99")
+NOISE_PREFIXES = ("ABC", "XYZ", "TEST")
+
+SHEET_NAME = 'Exported data'
+
+
+def _line_pairs(departments: Dict[str, Dict]) -> List[Tuple[str, str]]:
+    """
+    (MRP controller, description prefix) pairs of every line of the given departments.
+    """
+    pairs = []
+    for config in departments.values():
+        for mrp, prd_name in zip(config['mrp_controllers'], config['product_names']):
+            controllers = (mrp,) if isinstance(mrp, str) else mrp
+            prefixes = (prd_name,) if isinstance(prd_name, str) else prd_name
+            pairs.extend((c, p) for c in controllers for p in prefixes if c in production_site_map)
+
+    return sorted(set(pairs))
+
+
+def _polish_numbers(values: np.ndarray) -> List[str]:
+    # 1234.5 -> "1.234,5" (separator tysięcy kropka, przecinek dziesiętny) - jak w eksporcie ZSDKAP
+    return [
+        f"{v:,.0f}".replace(',', '.') if v.is_integer() else f"{v:,.1f}".replace(',', ' ').replace('.', ',').replace(' ', '.')
+        for v in values
+    ]
+
+
+def generate_materials(rng: np.random.Generator, count: int, departments: Dict[str, Dict]) -> pd.DataFrame:
+    """
+    Material master of the synthetic exports: ~90% materials of the lines, the rest noise.
+    """
+    pairs = _line_pairs(departments)
+    pair_idx = rng.integers(0, len(pairs), size=count)
+    controllers = np.array([c for c, _ in pairs])[pair_idx]
+    prefixes = np.array([p for _, p in pairs])[pair_idx]
+
+    noise = rng.random(count) < 0.1
+    controllers[noise] = rng.choice(NOISE_CONTROLLERS, size=int(noise.sum()))
+    prefixes[noise] = rng.choice(NOISE_PREFIXES, size=int(noise.sum()))
+
+    mat_numbers = (10_000_000 + rng.choice(90_000_000, size=count, replace=False)).astype(str)
+    return pd.DataFrame({
+        'mat_number': mat_numbers,
+        'mat_description': [f"{p} {m[-5:]}" for p, m in zip(prefixes, mat_numbers)],
+        'mrp_controller': controllers,
+        'plant': pd.Series(controllers).map(production_site_map).fillna("2101").to_numpy(),
+    })
+
+
+def generate_open_orders(rng: np.random.Generator, rows: int, materials: pd.DataFrame) -> pd.DataFrame:
+    """
+    ZSDKAP rows: orders with 1-5 positions (10, 20, ...), order numbers partly consecutive
+    (so the VBAP lookup gets BETWEEN ranges as in production).
+    """
+    positions_per_order = rng.integers(1, 6, size=rows)
+    positions_per_order = positions_per_order[:np.searchsorted(np.cumsum(positions_per_order), rows) + 1]
+    order_numbers = 1_000_000 + np.cumsum(rng.choice([1, 1, 1, 2, 7], size=len(positions_per_order)))
+
+    order_idx = np.repeat(np.arange(len(positions_per_order)), positions_per_order)[:rows]
+    starts = np.repeat(np.cumsum(positions_per_order) - positions_per_order, positions_per_order)[:rows]
+    positions = (np.arange(rows) - starts + 1) * 10
+
+    mat_idx = rng.integers(0, len(materials), size=rows)
+    quantities = rng.integers(1, 5000, size=rows).astype(float)
+    quantities[rng.random(rows) < 0.1] += 0.5
+
+    dates = np.array([(date.today() + timedelta(days=d)).strftime('%d.%m.%Y') for d in range(-5, 41)])
+
+    return pd.DataFrame({
+        'receiver': rng.choice(["R100", "R200", "R300"], size=rows),
+        'mat_number': materials['mat_number'].to_numpy()[mat_idx],
+        'mat_description': materials['mat_description'].to_numpy()[mat_idx],
+        'customer_order_number': pd.Series(order_numbers[order_idx]).astype(str).str.zfill(10).to_numpy(),
+        'customer_order_position': pd.Series(positions).astype(str).str.zfill(6).to_numpy(),
+        'mrp_controller': materials['mrp_controller'].to_numpy()[mat_idx],
+        'orders_quantity': np.where(rng.random(rows) < 0.01, "", _polish_numbers(quantities)),
+        'dispatch_date_original': dates[rng.integers(0, len(dates), size=rows)],
+    })
+
+
+def write_zsdkap_csv(orders: pd.DataFrame, path: Path) -> None:
+    # Nagłówek w maps.py jest w postaci z odczytu jako MacRoman (UTF-8 z SAP czytany jako MacRoman),
+    # zapis w MacRoman daje dokładnie te bajty co prawdziwy eksport
+    columns = {new: original for original, new in zsdkap_new_columns_names.items()}
+    export = orders.rename(columns=columns)
+    export['Typ zlecenia'] = 'ZOR'  # kolumny spoza maps.py - pomijane przez usecols
+    export['Jednostka'] = 'ST'
+    export.to_csv(path, sep=';', index=False, encoding='mac_roman')
+
+
+def write_export(df: pd.DataFrame, new_columns_names: Dict[str, str], path: Path) -> None:
+    columns = {new: original for original, new in new_columns_names.items()}
+    df.rename(columns=columns).to_excel(path, sheet_name=SHEET_NAME, index=False)
+
+
+def generate_exports(output_dir: str, rows: int, seed: int = 0,
+                     departments: Optional[Dict[str, Dict]] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Writes a synthetic set of the SAP job exports used by calculate_KPIs (file names as in DEPARTMENTS):
+    ZSDKAP csv with `rows` order rows, ZSBE per department, MB5TD_2101/0301, MB52 and ZKBP1_SB_0301 workbooks.
+    Material master and stock sheets grow with `rows` (capped, as in production they do not follow the orders).
+
+    :return: dict: SAP table -> DataFrame with the VBAP / EKKN / VBBE rows matching the exports
+             (for benchmarks.fake_rfc.FakeSapSystem)
+    """
+    if departments is None:
+        from calculate_KPIs import DEPARTMENTS as departments
+
+    rng = np.random.default_rng(seed)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    materials = generate_materials(rng, int(np.clip(rows // 20, 200, 50_000)), departments)
+    orders = generate_open_orders(rng, rows, materials)
+    write_zsdkap_csv(orders, output_dir / f"{generate_zsdkap_filename()}.csv")
+
+    # VBAP: zakład dostarczający + SOBKZ dla ~97% pozycji (reszta nie ma pozycji w SAP)
+    positions = orders[['customer_order_number', 'customer_order_position']]
+    positions = positions[rng.random(len(positions)) > 0.03]
+    vbap = pd.DataFrame({
+        'VBELN': positions['customer_order_number'].to_numpy(),
+        'POSNR': positions['customer_order_position'].to_numpy(),
+        'WERKS': rng.choice(DELIVERY_PLANTS, size=len(positions)),
+        'SOBKZ': np.where(rng.random(len(positions)) < 0.2, "E", ""),
+    })
+
+    # ZSBE - ten sam zestaw materiałów dla każdego działu, plus materiały '99' (odrzucane przez get_zsbe_df)
+    zsbe = pd.DataFrame({
+        'mat_number': materials['mat_number'],
+        'plant': materials['plant'],
+        'stock_quantity': rng.integers(0, 500, size=len(materials)).astype(float),
+        'mrp_controller': materials['mrp_controller'],
+        'safety_stock': rng.choice([0.0, 0.0, 5.0, 10.0, 50.0], size=len(materials)),
+        'mat_description': materials['mat_description'],
+    })
+    zsbe.loc[zsbe.index[:len(zsbe) // 100], 'mat_number'] = '99' + zsbe['mat_number'].str[2:]
+    zsbe_files = sorted({config['zsbe'] for config in departments.values()})
+    write_export(zsbe, zsbe_new_columns_names, output_dir / f"{zsbe_files[0]}.xlsx")
+    for name in zsbe_files[1:]:
+        shutil.copyfile(output_dir / f"{zsbe_files[0]}.xlsx", output_dir / f"{name}.xlsx")
+
+    # MB5TD - stany w drodze, zapas 'E' przypisany do zamówienia zakupu -> EKKN wskazuje zlecenie klienta
+    mb5t_rows = int(np.clip(rows // 50, 100, 20_000))
+    special = rng.random(mb5t_rows) < 0.4
+    purchase_orders = (4_500_000_000 + np.arange(mb5t_rows)).astype(str)
+    mb5t = pd.DataFrame({
+        'mat_number': materials['mat_number'].to_numpy()[rng.integers(0, len(materials), size=mb5t_rows)],
+        'plant': rng.choice(["2101", "0301"], size=mb5t_rows),
+        'supplying_plant': "2101",
+        'transit_quantity': rng.choice([0.0, 3.0, 10.0, 25.0], size=mb5t_rows),
+        'special_stock_indicator': np.where(special, "E", ""),
+        'purchase_order_number': purchase_orders,
+        'purchase_order_position': "00010",
+    })
+    mb5t_files = sorted({config['mb5t'] for config in departments.values()})
+    write_export(mb5t, mb5td_new_columns_names, output_dir / f"{mb5t_files[0]}.xlsx")
+    for name in mb5t_files[1:]:
+        shutil.copyfile(output_dir / f"{mb5t_files[0]}.xlsx", output_dir / f"{name}.xlsx")
+
+    ekkn_orders = orders.iloc[rng.integers(0, len(orders), size=int(special.sum()))]
+    ekkn = pd.DataFrame({
+        'EBELN': purchase_orders[special],
+        'EBELP': "00010",
+        'VBELN': ekkn_orders['customer_order_number'].to_numpy(),
+        'VBELP': ekkn_orders['customer_order_position'].to_numpy(),
+    })
+
+    # MB52 - zapas magazynowy; ~30% to zapas zlecenia klienta (numery bez zer wiodących, jak w eksporcie)
+    mb52_rows = int(np.clip(rows // 10, 200, 100_000))
+    special = rng.random(mb52_rows) < 0.3
+    mb52_orders = orders.iloc[rng.integers(0, len(orders), size=mb52_rows)]
+    mb52 = pd.DataFrame({
+        'mat_number': np.where(rng.random(mb52_rows) < 0.8, mb52_orders['mat_number'].to_numpy(),
+                               materials['mat_number'].to_numpy()[rng.integers(0, len(materials), size=mb52_rows)]),
+        'stock_quantity': rng.integers(0, 30, size=mb52_rows).astype(float),
+        'customer_order_number': np.where(special, mb52_orders['customer_order_number'].str.lstrip('0').to_numpy(), None),
+        'customer_order_position': np.where(special, mb52_orders['customer_order_position'].str.lstrip('0').to_numpy(), None),
+        'delivery_plant': rng.choice(["2101", "0301"], size=mb52_rows),
+        'storage_location': rng.choice(['0004', '0005', 'FSC', '0003', '0007', '9999'], size=mb52_rows),
+    })
+    mb52_files = sorted({config['mb52'] for config in departments.values()})
+    for name in mb52_files:
+        write_export(mb52, mb52_new_columns_names, output_dir / f"{name}.xlsx")
+
+    # ZKBP1 - kanban dla materiałów zakładu 0301 (NrMat. jako liczba, jak w eksporcie)
+    kanban = materials[materials['plant'] == "0301"]
+    kanban = kanban.iloc[:max(1, len(kanban) // 4)]
+    zkbp1 = pd.DataFrame({
+        'mat_number': kanban['mat_number'].astype(np.int64).to_numpy(),
+        'num_of_containers': rng.integers(1, 5, size=len(kanban)).astype(float),
+        'container_capacity': rng.choice([5.0, 10.0, 20.0], size=len(kanban)),
+        'mat_name': kanban['mat_description'].to_numpy(),
+    })
+    zkbp1_files = sorted({config.get('zkbp1_report_name', "ZKBP1_SB_0301") for config in departments.values()})
+    for name in zkbp1_files:
+        write_export(zkbp1, zkbp1_new_columns_names, output_dir / f"{name}.xlsx")
+
+    return {
+        'VBAP': vbap,
+        'VBBE': vbap[['VBELN', 'POSNR', 'SOBKZ']],
+        'EKKN': ekkn,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic SAP exports for the KPI pipeline")
+    parser.add_argument('output_dir')
+    parser.add_argument('--rows', type=int, default=10_000, help="ZSDKAP order rows")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tables = generate_exports(args.output_dir, args.rows, args.seed)
+    print(f"Exports written to {args.output_dir} ({args.rows} ZSDKAP rows, "
+          + ", ".join(f"{table}: {len(df)} rows" for table, df in tables.items()) + ")")
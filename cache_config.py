@@ -0,0 +1,30 @@
+import os
+from datetime import timedelta
+import tempfile
+from pathlib import Path
+
+# Lokalny katalog na cache - nie na udziale sieciowym, żeby odczyt był szybki
+CACHE_DIR = Path(os.environ.get("PPS_KPI_CACHE_DIR", Path(tempfile.gettempdir()) / "pps_kpi_cache"))
+
+EXCEL_CACHE_ENABLED = os.environ.get("PPS_KPI_EXCEL_CACHE", "1") != "0"
+EXCEL_CACHE_DIR = CACHE_DIR / "excel"
+
+RFC_CACHE_ENABLED = os.environ.get("PPS_KPI_RFC_CACHE", "1") != "0"
+RFC_CACHE_PATH = CACHE_DIR / "rfc_cache.sqlite"
+
+# Jak długo wynik RFC dla klucza jest aktualny (per tabela SAP)
+RFC_CACHE_DEFAULT_TTL = timedelta(days=1)
+RFC_CACHE_TTL = {
+    "VBAP": timedelta(days=3),   # zakład dostarczający pozycji zlecenia zmienia się rzadko
+    "EKKN": timedelta(days=1),
+    "VBBE": timedelta(hours=12),
+}
+
+# Historia KPI (append-only) - to nie jest cache, więc domyślnie poza CACHE_DIR
+KPI_STORE_PATH = Path(os.environ.get("PPS_KPI_STORE", Path.home() / "pps_kpi" / "kpi_history.sqlite"))
+
+# Nagrania wywołań RFC_READ_TABLE (--rfc-mode record / replay) - archiwum do powtórek, też poza CACHE_DIR
+RFC_ARCHIVE_PATH = Path(os.environ.get("PPS_KPI_RFC_ARCHIVE", Path.home() / "pps_kpi" / "rfc_archive.sqlite"))
+
+# Stan przyrostowego przeliczania (--incremental): odciski wejść i wynik szczegółowy per linia
+INCREMENTAL_STATE_DIR = CACHE_DIR / "incremental"
@@ -1,22 +1,50 @@
-import sys
+import argparse
+import contextvars
+import multiprocessing
 import traceback
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
 
-from helper_functions import append_data_to_excel, get_nth_working_day, clean_number, generate_zsdkap_filename
+from cache_config import RFC_CACHE_ENABLED, RFC_ARCHIVE_PATH, INCREMENTAL_STATE_DIR
+from excel_cache import read_excel_cached
+from helper_functions import (append_rows_to_excel, get_nth_working_day, parse_polish_numbers, generate_zsdkap_filename,
+                              fillna_zero, build_shared_categories, to_compact, upcast_floats)
+from incremental import LineState, only_mats
+from kpi_engine import calculate_to_be_produced, build_horizon_orders_matrix
+from kpi_store import KpiStore, rebuild_excel
+from line_index import build_line_index, line_rows_mask
+from log_utils import setup_logger, stage_timer, stage_tags, set_stage_tags, run_profiled
 from py_rfc_methods import get_delivery_plants_df, get_purchase_order_sales_orders
-from shipping_logic import get_production_shipping_date
+from output_sinks import DETAIL_OUTPUT_MODES, XlsxDetailSink, make_detail_sink
+from rfc_replay import RFC_MODES, set_rfc_mode, parse_replay_latency
+from shared_frames import shared_frames, load_shared_frames
+from shipping_logic import get_production_shipping_dates
 
 KPIS_FILE_PATH = r"P:\Technisch\PLANY PRODUKCJI\PLANIŚCI\PP_TOOLS_TEMP_FILES\07_PPS_KPIs\KPIs_source_data.xlsx"
 # KPIS_FILE_PATH = r"P:\Technisch\PLANY PRODUKCJI\PLANIŚCI\PP_TOOLS_TEMP_FILES\07_PPS_KPIs\KPIs_source_data_test.xlsx"
 OUTPUT_FILE_PATH = r"P:\Technisch\PLANY PRODUKCJI\PLANIŚCI\PP_TOOLS_TEMP_FILES\07_PPS_KPIs\OUTPUT"
 ERROR_PATH = r"P:\Technisch\PLANY PRODUKCJI\PLANIŚCI\PP_TOOLS_TEMP_FILES\07_PPS_KPIs\error.log"
+# Folder with the SAP job exports (ZSDKAP csv, ZSBE / MB5TD / MB52 / ZKBP1 xlsx) - benchmarks point it at generated files
+SAP_EXPORTS_DIR = r'\\rfmesrv5\connect\DST_SAP_Transfer\P11\PPS_LUB\02_MID_TERM_PLANNING_ALIGNMENT'
 
 
 SAP_SYSTEM = "P11_SSO"
 # SAP_SYSTEM = "K11"
+RFC_MAX_WORKERS = 4  # parallel SAP connections used for chunked RFC lookups
+ZSDKAP_CHUNK_SIZE = 200_000  # rows per chunk when streaming the ZSDKAP export
+RFC_FORCE_REFRESH = False  # ignore the local VBAP/EKKN cache and ask SAP for every key (--refresh-rfc-cache)
+COMPACT_DTYPES = False  # shared categoricals for key columns + float32 quantities (--compact)
+WRITE_EXCEL = True  # append results to KPIS_FILE_PATH as well, not only to the KPI store (--no-excel)
+LINE_WORKERS = 1  # worker processes for the per-line KPI calculation, 1 = in this process (--line-workers)
+DETAIL_OUTPUT = 'xlsx'  # per-line detail output: xlsx, csv, parquet, workbook (one per run), none (--detail-output)
+SOURCE_IO_WORKERS = 4  # threads reading ZSBE / ZKBP1 / MB5TD (+ EKKN) / MB52 while ZSDKAP + VBAP is loading
+INCREMENTAL = False  # recalculate only materials whose inputs changed since the previous run (--incremental)
+PAUSE_ON_ERROR = True  # kpis_loop waits for Enter after an error; False = the error is raised to the caller (--non-interactive)
+
+stage_log = setup_logger("KPI_STAGES", "stages.log")
 
 
 from maps import (
@@ -37,11 +65,11 @@ def create_paths(zsdkap_report_name, zsbe_report_name, mb5t_report_name, mb52_re
     # MB5TD_2101 = fr'C:\Temp\Kamil\Prywatne\07_Programowanie\99_Moje_projekty/28_PPS_KPI\excel_files/job/{mb5t_report_name}.xlsx'
     # MB52_FILE_PATH = f'C:/Temp/Kamil/Prywatne/07_Programowanie/99_Moje_projekty/28_PPS_KPI/excel_files/job/{mb52_report_name}.xlsx'
 
-    ZSDKAP_FILE_PATH = fr'\\rfmesrv5\connect\DST_SAP_Transfer\P11\PPS_LUB\02_MID_TERM_PLANNING_ALIGNMENT/{zsdkap_report_name}.csv'
-    ZSBE_FILE_PATH = fr'\\rfmesrv5\connect\DST_SAP_Transfer\P11\PPS_LUB\02_MID_TERM_PLANNING_ALIGNMENT/{zsbe_report_name}.xlsx'
-    MB5TD_2101 = fr'\\rfmesrv5\connect\DST_SAP_Transfer\P11\PPS_LUB\02_MID_TERM_PLANNING_ALIGNMENT/{mb5t_report_name}.xlsx'
-    MB52_FILE_PATH = fr'\\rfmesrv5\connect\DST_SAP_Transfer\P11\PPS_LUB\02_MID_TERM_PLANNING_ALIGNMENT/{mb52_report_name}.xlsx'
-    ZKBP1_FILE_PATH = fr'\\rfmesrv5\connect\DST_SAP_Transfer\P11\PPS_LUB\02_MID_TERM_PLANNING_ALIGNMENT/{zkbp1_report_name}.xlsx'
+    ZSDKAP_FILE_PATH = fr'{SAP_EXPORTS_DIR}/{zsdkap_report_name}.csv'
+    ZSBE_FILE_PATH = fr'{SAP_EXPORTS_DIR}/{zsbe_report_name}.xlsx'
+    MB5TD_2101 = fr'{SAP_EXPORTS_DIR}/{mb5t_report_name}.xlsx'
+    MB52_FILE_PATH = fr'{SAP_EXPORTS_DIR}/{mb52_report_name}.xlsx'
+    ZKBP1_FILE_PATH = fr'{SAP_EXPORTS_DIR}/{zkbp1_report_name}.xlsx'
 
     # ZSDKAP_FILE_PATH = fr'\\rfmesrv5\connect\DST_SAP_Transfer\P11\PPS_LUB\02_MID_TERM_PLANNING_ALIGNMENT\test_k11/{zsdkap_report_name}.csv'
     # ZSBE_FILE_PATH = fr'\\rfmesrv5\connect\DST_SAP_Transfer\P11\PPS_LUB\02_MID_TERM_PLANNING_ALIGNMENT\test_k11/{zsbe_report_name}.xlsx'
@@ -50,12 +78,14 @@ def create_paths(zsdkap_report_name, zsbe_report_name, mb5t_report_name, mb52_re
     # ZKBP1_FILE_PATH = fr'\\rfmesrv5\connect\DST_SAP_Transfer\P11\PPS_LUB\02_MID_TERM_PLANNING_ALIGNMENT\test_k11/{zkbp1_report_name}.xlsx'
 
 
-def get_zsdkap_df(mrp_controller, mat_name, df, date_limit=None):
-    tmp = df.copy()
+def get_zsdkap_df(mrp_controller, mat_name, df, date_limit=None, rows=None):
+    # rows - positions of the line's rows from the line index (skips the controller/description scan)
+    tmp = df.copy() if rows is None else df.iloc[rows]
     if date_limit is not None:
         tmp = tmp[tmp['dispatch_date'] <= date_limit]
 
-    tmp = tmp[(tmp['mrp_controller'].isin(mrp_controller)) & (tmp['mat_description'].str.startswith(mat_name))]
+    if rows is None:
+        tmp = tmp[(tmp['mrp_controller'].isin(mrp_controller)) & (tmp['mat_description'].str.startswith(mat_name))]
     tmp = tmp[['mat_number', 'orders_quantity', 'customer_order_number', 'customer_order_position', 'delivery_plant', 'mat_description', 'special_stock_indicator']]
     # return tmp.groupby('mat_number', as_index=False).sum()
     return tmp
@@ -70,20 +100,105 @@ def get_zsdkap_customer_orders_numbers(mrp_controller, mat_name, df, date_limit=
     return tmp
 
 
-def load_open_orders_and_adjust_dispatch_date(file_path):
-    raw_df = pd.read_csv(file_path, dtype=zsdkap_dtypes, sep=';', encoding='MacRoman')
-    raw_df['WADAT'] = pd.to_datetime(raw_df['WADAT'], dayfirst=True, errors='coerce')
-    raw_df = raw_df.rename(columns=zsdkap_new_columns_names)
-    # TODO: Here implement dispatch date recalculation
-    raw_df['production_site'] = raw_df['mrp_controller'].apply(lambda mrp: production_site_map.get(mrp))
-    delivery_plants = get_delivery_plants_df(SAP_SYSTEM, raw_df['customer_order_number'].tolist(), 1000, 100)
-    delivery_plants = delivery_plants.rename(columns=vbap_new_columns_names)
-    raw_df = pd.merge(raw_df, delivery_plants, how='left', on=['customer_order_number', 'customer_order_position'])
-    raw_df.dropna(subset=['production_site', 'delivery_plant'], inplace=True)
-    # raw_df.to_excel(f"{OUTPUT_FILE_PATH}/before-implementation.xlsx")
-    raw_df['dispatch_date'] = raw_df.apply(
-        lambda row: get_production_shipping_date(row['dispatch_date_original'], row['production_site'],
-                                                 row['delivery_plant']), axis=1)
+def get_lines_filter(mrp_controllers, product_names):
+    """
+    Union of MRP controllers and material description prefixes used by the given lines.
+    """
+    controllers, prefixes = set(), set()
+    for mrp, prd_name in zip(mrp_controllers, product_names):
+        controllers.update((mrp,) if isinstance(mrp, str) else mrp)
+        prefixes.update((prd_name,) if isinstance(prd_name, str) else prd_name)
+
+    return controllers, tuple(sorted(prefixes))
+
+
+# ZSDKAP columns the KPI calculation reads (receiver is only informational)
+ZSDKAP_REQUIRED_COLUMNS = ('mat_number', 'mat_description', 'customer_order_number', 'customer_order_position',
+                           'mrp_controller', 'orders_quantity', 'dispatch_date_original')
+
+
+def read_zsdkap_csv(file_path, mrp_controllers=None, mat_prefixes=None, chunksize=ZSDKAP_CHUNK_SIZE):
+    """
+    Streams the ZSDKAP export in chunks: reads only the mapped columns, drops rows of MRP controllers /
+    descriptions no line uses and parses WADAT and quantities chunk by chunk, so memory follows the
+    filtered rows instead of the whole export.
+
+    :return: tuple: (DataFrame with renamed columns, number of quantities that failed to parse)
+    """
+    filtered_chunks = []
+    failed_quantities = 0
+
+    # Kolumny mapy, których brak w eksporcie, są pomijane - wymagane są tylko te czytane przez KPI
+    for chunk in pd.read_csv(file_path, dtype=zsdkap_dtypes, sep=';', encoding='MacRoman',
+                             usecols=lambda col: col in zsdkap_new_columns_names, chunksize=chunksize):
+        chunk = chunk.rename(columns=zsdkap_new_columns_names)
+        missing = [col for col in ZSDKAP_REQUIRED_COLUMNS if col not in chunk.columns]
+        if missing:
+            raise ValueError(f"Brak kolumn w eksporcie ZSDKAP {file_path}: "
+                             + ", ".join(original for original, name in zsdkap_new_columns_names.items() if name in missing))
+
+        if mrp_controllers is not None:
+            chunk = chunk[chunk['mrp_controller'].isin(mrp_controllers)]
+        if mat_prefixes is not None:
+            chunk = chunk[chunk['mat_description'].str.startswith(mat_prefixes).fillna(False).astype(bool)]
+
+        chunk = chunk.copy()
+        chunk['dispatch_date_original'] = pd.to_datetime(chunk['dispatch_date_original'], dayfirst=True, errors='coerce')
+        chunk['orders_quantity'], chunk_failed = parse_polish_numbers(chunk['orders_quantity'])
+        failed_quantities += chunk_failed
+
+        filtered_chunks.append(chunk)
+
+    return pd.concat(filtered_chunks, ignore_index=True), failed_quantities
+
+
+def get_lines_mask(df, mrp_controllers, product_names):
+    """
+    True for rows that belong to at least one line (MRP controller of the line and description
+    starting with one of the line's product names).
+    """
+    line_index = build_line_index(df, range(len(mrp_controllers)), mrp_controllers, product_names)
+    return line_rows_mask(line_index, len(df))
+
+
+def load_open_orders_and_adjust_dispatch_date(file_path, mrp_controllers=None, product_names=None):
+    """
+    :param mrp_controllers: MRP controllers of every line to calculate (None = keep all rows)
+    :param product_names: description prefixes of every line, in the same order as mrp_controllers
+    """
+    lines_filter = get_lines_filter(mrp_controllers, product_names) if mrp_controllers is not None else (None, None)
+    with stage_timer(stage_log, 'zsdkap_csv_load') as timer:
+        raw_df, failed_quantities = read_zsdkap_csv(file_path, *lines_filter)
+        timer.fields['rows'] = len(raw_df)
+    if failed_quantities:
+        print(f"Uwaga: {failed_quantities} wartości 'orders_quantity' w ZSDKAP nie udało się przekonwertować na liczbę (NaN)")
+
+    # Only orders that can affect a KPI are sent to SAP: known production site and matching at least one line
+    raw_df['production_site'] = raw_df['mrp_controller'].map(production_site_map)
+    raw_df.dropna(subset=['production_site'], inplace=True)
+    if mrp_controllers is not None:
+        raw_df = raw_df[get_lines_mask(raw_df, mrp_controllers, product_names)]
+
+    with stage_timer(stage_log, 'vbap_rfc') as timer:
+        orders = raw_df['customer_order_number'].unique().tolist()
+        delivery_plants = get_delivery_plants_df(SAP_SYSTEM, orders, 2000, 100,
+                                                 max_workers=RFC_MAX_WORKERS, use_cache=RFC_CACHE_ENABLED,
+                                                 force_refresh=RFC_FORCE_REFRESH)
+        timer.fields.update(keys=len(orders), rows=len(delivery_plants))
+
+    with stage_timer(stage_log, 'dispatch_date_adjustment') as timer:
+        delivery_plants = delivery_plants.rename(columns=vbap_new_columns_names)
+        raw_df = pd.merge(raw_df, delivery_plants, how='left', on=['customer_order_number', 'customer_order_position'])
+        raw_df.dropna(subset=['production_site', 'delivery_plant'], inplace=True)
+        # raw_df.to_excel(f"{OUTPUT_FILE_PATH}/before-implementation.xlsx")
+        raw_df['dispatch_date'], unknown_route = get_production_shipping_dates(
+            raw_df['dispatch_date_original'], raw_df['production_site'], raw_df['delivery_plant'])
+        timer.fields['rows'] = len(raw_df)
+
+    if unknown_route.any():
+        routes = raw_df.loc[unknown_route, ['production_site', 'delivery_plant']].drop_duplicates()
+        print(f"Uwaga: brak zdefiniowanej trasy dla {int(unknown_route.sum())} wierszy ZSDKAP (dispatch_date = NaT): "
+              + ", ".join(f"{p} -> {d}" for p, d in routes.itertuples(index=False)))
 
     return raw_df
 
@@ -93,50 +208,76 @@ def fill_general_stock_information(df):
 
     return df
 
-def get_zsdkap_merged_df(horizons, mrp_controller, mat_name, raw_df):
-    raw_df['orders_quantity'] = raw_df['orders_quantity'].apply(clean_number)
+def get_zsdkap_merged_df(horizons, mrp_controller, mat_name, raw_df, rows=None):
     # TODO: Dopracować logikę merga - konieczne będzie zastąpienie numerów zlec klienta i pozycji zunifikowanym tagiem "general_stock_position"
     # 2. Base (total) dataframe
-    zsdkap_total_df = get_zsdkap_df(mrp_controller, mat_name, raw_df)
+    zsdkap_total_df = get_zsdkap_df(mrp_controller, mat_name, raw_df, rows=rows)
+
+    # 3. Horizons - rows are binned once against all horizon cutoffs
+    cutoffs = [get_nth_working_day(h) for h in horizons]
+    horizon_orders = build_horizon_orders_matrix(
+        raw_df.loc[zsdkap_total_df.index, 'dispatch_date'],
+        zsdkap_total_df['orders_quantity'],
+        cutoffs
+    )
 
-    # 3. Horizons
-    horizons = horizons
-    dfs = []
+    zsdkap_merged_df = zsdkap_total_df.assign(**{
+        f'orders_quantity_{h}_days': horizon_orders[:, i] for i, h in enumerate(horizons)
+    })
 
-    for h in horizons:
-        df_h = get_zsdkap_df(mrp_controller, mat_name, raw_df, date_limit=get_nth_working_day(h))
-        df_h = df_h.rename(columns={'orders_quantity': f'orders_quantity_{h}_days'})
-        df_h = df_h.drop(columns=['mat_description', 'special_stock_indicator'])
-        dfs.append(df_h)
+    return zsdkap_merged_df
 
-    # 4. Merge everything
-    zsdkap_merged_df = zsdkap_total_df
-    for df_h in dfs:
-        zsdkap_merged_df = zsdkap_merged_df.merge(df_h, on=['mat_number', 'customer_order_number', 'customer_order_position', 'delivery_plant'], how='left')
 
-    return zsdkap_merged_df
+def read_export(file_path, dtype, source):
+    """
+    SAP export (sheet 'Exported data') through the local Excel cache, logged as stage excel_read.
+    """
+    with stage_timer(stage_log, 'excel_read', source=source) as timer:
+        df = read_excel_cached(file_path, sheet_name='Exported data', dtype=dtype)
+        timer.fields['rows'] = len(df)
+
+    return df
 
 
-def get_zsbe_df(mrp_controller, include_zkbp1_sb, mat_name):
-    zsbe_df = pd.read_excel(ZSBE_FILE_PATH, sheet_name='Exported data', dtype=zsbe_dtypes)
-    zsbe_df = zsbe_df.rename(columns=zsbe_new_columns_names)
-    zsbe_df = zsbe_df[(zsbe_df['mrp_controller'].isin(mrp_controller)) & (~zsbe_df['mat_number'].str.startswith('99'))
-                      & (zsbe_df['mat_description'].str.startswith(mat_name))]
-    zsbe_df = zsbe_df[['mat_number', 'mat_description', 'safety_stock', 'plant']]
+def read_zsbe_raw_df():
+    zsbe_df = read_export(ZSBE_FILE_PATH, zsbe_dtypes, 'zsbe')
+    return zsbe_df.rename(columns=zsbe_new_columns_names)
+
+
+def read_zkbp1_df():
+    zkbp1_df = read_export(ZKBP1_FILE_PATH, zkbp1_dtypes, 'zkbp1')
+    zkbp1_df = zkbp1_df.rename(columns=zkbp1_new_columns_names)
+    zkbp1_df['mat_number'] = zkbp1_df['mat_number'].astype(str)
+    zkbp1_df['safety_stock_kanban'] = zkbp1_df['num_of_containers'] * zkbp1_df['container_capacity']
+    zkbp1_df['plant'] = "0301"
+    zkbp1_df = zkbp1_df[[
+        'mat_number',
+        'safety_stock_kanban',
+        'plant', ]]
+
+    return zkbp1_df
+
+
+def get_zsbe_df(mrp_controller, include_zkbp1_sb, mat_name, zsbe_raw_df=None, zkbp1_df=None, rows=None):
+    if zsbe_raw_df is None:
+        zsbe_raw_df = read_zsbe_raw_df()
+
+    if rows is not None:
+        # Line rows from the line index, only the '99' materials are left to drop
+        zsbe_df = zsbe_raw_df.iloc[rows]
+        zsbe_df = zsbe_df[~zsbe_df['mat_number'].str.startswith('99')]
+    else:
+        zsbe_df = zsbe_raw_df[(zsbe_raw_df['mrp_controller'].isin(mrp_controller)) & (~zsbe_raw_df['mat_number'].str.startswith('99'))
+                              & (zsbe_raw_df['mat_description'].str.startswith(mat_name))]
+    # float32 w trybie --compact -> float64 przed dodaniem zapasu kanban
+    zsbe_df = upcast_floats(zsbe_df[['mat_number', 'mat_description', 'safety_stock', 'plant']])
     zsbe_df['customer_order_number'] = 'general_stock_position'
     zsbe_df['customer_order_position'] = 'general_stock_position'
 
     # Include safety stocks from ZKBP1 transaction
     if include_zkbp1_sb:
-        zkbp1_df = pd.read_excel(ZKBP1_FILE_PATH, sheet_name='Exported data', dtype=zkbp1_dtypes)
-        zkbp1_df = zkbp1_df.rename(columns=zkbp1_new_columns_names)
-        zkbp1_df['mat_number'] = zkbp1_df['mat_number'].astype(str)
-        zkbp1_df['safety_stock_kanban'] = zkbp1_df['num_of_containers'] * zkbp1_df['container_capacity']
-        zkbp1_df['plant'] = "0301"
-        zkbp1_df = zkbp1_df[[
-            'mat_number',
-            'safety_stock_kanban',
-            'plant', ]]
+        if zkbp1_df is None:
+            zkbp1_df = read_zkbp1_df()
 
         zsbe_zkbp1_merged = pd.merge(zsbe_df, zkbp1_df, on=['mat_number', 'plant'], how='left')
         zsbe_zkbp1_merged['safety_stock_kanban'] = zsbe_zkbp1_merged['safety_stock_kanban'].fillna(0)
@@ -144,7 +285,7 @@ def get_zsbe_df(mrp_controller, include_zkbp1_sb, mat_name):
         zsbe_df = zsbe_zkbp1_merged
 
     zsbe_df = zsbe_df[['mat_number', 'plant', 'mat_description', 'safety_stock', 'customer_order_number', 'customer_order_position']]
-    zsbe_df = zsbe_df.groupby(['mat_number', 'plant'], as_index=False).agg({
+    zsbe_df = zsbe_df.groupby(['mat_number', 'plant'], as_index=False, observed=True).agg({
         'mat_description': 'first',  # Wybierz pierwszą wartość
         'customer_order_number': 'first',
         'customer_order_position': 'first',
@@ -156,11 +297,14 @@ def get_zsbe_df(mrp_controller, include_zkbp1_sb, mat_name):
 
 def get_mb5t_df():
     # TODO: Specify correct MB5TD file (either 2101 or 0301)
-    mb5t_df = pd.read_excel(MB5TD_2101, sheet_name='Exported data', dtype=mb5td_dtypes)
+    mb5t_df = read_export(MB5TD_2101, mb5td_dtypes, 'mb5td')
     mb5t_df = mb5t_df.rename(columns=mb5td_new_columns_names)
 
     po_list = mb5t_df[mb5t_df['special_stock_indicator'] == 'E']['purchase_order_number'].tolist()
-    sales_orders = get_purchase_order_sales_orders(SAP_SYSTEM, po_list)
+    with stage_timer(stage_log, 'ekkn_rfc') as timer:
+        sales_orders = get_purchase_order_sales_orders(SAP_SYSTEM, po_list, max_workers=RFC_MAX_WORKERS,
+                                                       use_cache=RFC_CACHE_ENABLED, force_refresh=RFC_FORCE_REFRESH)
+        timer.fields.update(keys=len(set(po_list)), rows=len(sales_orders))
     sales_orders = sales_orders.rename(columns=ekkn_new_columns_names)
 
     mb5t_df = mb5t_df.merge(sales_orders, how='left', on=['purchase_order_number', 'purchase_order_position'])
@@ -170,7 +314,7 @@ def get_mb5t_df():
     special_stock_df = mb5t_df[mb5t_df['special_stock_indicator'] == 'E']
     general_stock_df = (
         mb5t_df[mb5t_df['special_stock_indicator'] != 'E']
-        .groupby(['plant', 'mat_number'], as_index=False)
+        .groupby(['plant', 'mat_number'], as_index=False, observed=True)
         .agg({
             'transit_quantity': 'sum',
             'customer_order_number': 'first',
@@ -185,7 +329,7 @@ def get_mb5t_df():
 
 
 def get_mb52_df(storage_locs):
-    mb52_df = pd.read_excel(MB52_FILE_PATH, sheet_name='Exported data', dtype=mb52_dtypes)
+    mb52_df = read_export(MB52_FILE_PATH, mb52_dtypes, 'mb52')
     mb52_df = mb52_df.rename(columns=mb52_new_columns_names)
 
     mb52_df["customer_order_number"] = (
@@ -200,56 +344,49 @@ def get_mb52_df(storage_locs):
     return mb52_df
 
 
-def calculate_order_level_KPI(horizons=None,
-                              mrp_controller='L1K',
-                              mat_name='R4',
-                              ready_goods_storage_locs=('0004', '0005', 'FSC'),
-                              include_zkbp1_sb=False,
-                              zsdkap_raw_df=None):
-
-    def calculate_to_be_produced_all(row):
-        stock_quantity = row['stock_quantity'] + row['transit_quantity']
-        if (stock_quantity - row['orders_quantity'] >= row['safety_stock']) and row['safety_stock'] > 0:
-            return 0
-        else:
-            if row['orders_quantity'] + row['safety_stock'] - stock_quantity > 0:
-                return row['orders_quantity'] + row['safety_stock'] - stock_quantity
-            else:
-                return 0
-
-    def calculate_to_be_produced_gr_c(row, col_suffix=""):
-        orders_quantity_column_name = f'orders_quantity{col_suffix}'
-        # stock_quantity = row[f'stock_quantity{col_suffix}'] + row['transit_quantity']
-        stock_quantity = row[f'stock_quantity'] + row['transit_quantity']
-        if stock_quantity < row[orders_quantity_column_name]:
-            return row[orders_quantity_column_name] - stock_quantity
-        else:
-            return 0
+def submit_source_snapshot(executor, ready_goods_storage_locs, include_zkbp1_sb):
+    """
+    Starts every line-independent source read (ZSBE, ZKBP1, MB5TD + EKKN lookup, MB52) as its own task,
+    so waiting for the network share and for SAP overlaps. File paths are taken from create_paths.
 
-    # Ensure mrp_controller is always a tuple
-    if not isinstance(mrp_controller, (list, tuple, set, pd.Series)):
-        mrp_controller = mrp_controller,
+    :return: dict: source name -> Future (None for ZKBP1 if not included)
+    """
+    def submit(func, *args):
+        # Reader threads keep the stage tags (department) of the caller
+        return executor.submit(contextvars.copy_context().run, func, *args)
 
-    # Ensure mat_name is always a tuple
-    if not isinstance(mat_name, (list, tuple, set, pd.Series)):
-        mat_name = mat_name,
+    return {
+        'zsbe': submit(read_zsbe_raw_df),
+        'zkbp1': submit(read_zkbp1_df) if include_zkbp1_sb else None,
+        'mb5t': submit(get_mb5t_df),
+        'mb52': submit(get_mb52_df, ready_goods_storage_locs),
+    }
 
-    # create_paths(zsdkap_report_name, zsbe_report_name, mb5t_report_name, mb52_report_name, zkbp1_report_name)
 
-    horizons = horizons
-    zsdkap_merged_df = get_zsdkap_merged_df(horizons, mrp_controller, mat_name, zsdkap_raw_df.copy())
+def collect_source_snapshot(source_futures):
+    # Błąd w którymkolwiek odczycie jest zgłaszany tutaj
+    return {name: None if future is None else future.result() for name, future in source_futures.items()}
 
-    # zsdkap_merged_df.to_excel(r'excel_files\bq–issue–tests\zsdkap_merged_df.xlsx', index=False)
-    zsbe_df = get_zsbe_df(mrp_controller, include_zkbp1_sb, mat_name)
-    mb5t_df = get_mb5t_df()
-    mb52_df = get_mb52_df(ready_goods_storage_locs)
 
-    zsdkap_df = zsdkap_raw_df.copy()
+def load_source_snapshot(ready_goods_storage_locs, include_zkbp1_sb):
+    """
+    Reads every line-independent source (ZSBE, ZKBP1, MB5TD + EKKN lookup, MB52) once per run.
+    Lines only filter the returned frames, so the exports and SAP lookups are not repeated per line.
+    """
+    with ThreadPoolExecutor(max_workers=SOURCE_IO_WORKERS) as executor:
+        return collect_source_snapshot(submit_source_snapshot(executor, ready_goods_storage_locs, include_zkbp1_sb))
 
-    # Przetwarzanie konkretnej kolumny
-    zsdkap_df['orders_quantity'] = zsdkap_df['orders_quantity'].apply(clean_number)
 
-    zsbe_df = zsbe_df.rename(columns={'plant': 'delivery_plant'})
+def build_line_detail(zsdkap_merged_df, zsbe_df, mb5t_df, mb52_df):
+    """
+    Merges the line's ZSDKAP orders and ZSBE safety stocks with MB5TD transit and MB52 stocks - one row per
+    general stock (material, plant) and per special stock order position, before to_be_produced_* is added.
+    Every merge is keyed on mat_number, so rows of a material depend only on that material's input rows.
+    """
+    # Ilości sumowane poniżej liczone w float64 także w trybie --compact (suma float32 powyżej 2**24 się zaokrągla)
+    zsdkap_merged_df = upcast_floats(zsdkap_merged_df)
+    mb5t_df = upcast_floats(mb5t_df).copy()
+    zsbe_df = upcast_floats(zsbe_df).rename(columns={'plant': 'delivery_plant'})
 
     zsdkap_zsbe_merged_df = pd.merge(zsdkap_merged_df, zsbe_df, on=['mat_number', 'customer_order_number', 'customer_order_position', 'delivery_plant'], how='outer')
     # zsdkap_zsbe_merged_df.to_excel(r'excel_files\bq–issue–tests\zsdkap_zsbe_merged_df.xlsx', index=False)
@@ -263,25 +400,28 @@ def calculate_order_level_KPI(horizons=None,
         inplace=True
     )
     # zsdkap_zsbe_merged_df.to_excel(r'excel_files\bq–issue–tests\zsdkap_zsbe_merged_df.xlsx', index=False)
-    zsdkap_zsbe_merged_df['special_stock_indicator'] = zsdkap_zsbe_merged_df['special_stock_indicator'].replace('', pd.NA).fillna('general_stock')
-    zsdkap_zsbe_merged_df.fillna(0, inplace=True)
+    special_stock_indicator = zsdkap_zsbe_merged_df['special_stock_indicator']
+    # mask() instead of replace('', pd.NA) - also keeps categorical columns categorical
+    zsdkap_zsbe_merged_df['special_stock_indicator'] = special_stock_indicator.mask(special_stock_indicator == '').fillna('general_stock')
+    fillna_zero(zsdkap_zsbe_merged_df)
 
     mb5t_df.rename(columns={'plant': 'delivery_plant'}, inplace=True)
+    order_keys = mb5t_df[['customer_order_number', 'customer_order_position']]
     mb5t_df[['customer_order_number', 'customer_order_position']] = (
-        mb5t_df[['customer_order_number', 'customer_order_position']]
-        .replace('', pd.NA)
+        order_keys
+        .mask(order_keys == '')
         .fillna('general_stock_position')
     )
     # mb5t_df.to_excel(r'excel_files\bq–issue–tests\mb5t_df.xlsx', index=False)
 
     zsdkap_zsbe_mb5t_merged_df = pd.merge(zsdkap_zsbe_merged_df, mb5t_df, on=['mat_number', 'customer_order_number', 'customer_order_position', 'delivery_plant'], how='left')
 
-    zsdkap_zsbe_mb5t_merged_df.fillna(0, inplace=True)
+    fillna_zero(zsdkap_zsbe_mb5t_merged_df)
 
     # Add appropriate grouping for MB52 general stocks (by mat num and plant)
-    mb52_special_stocks_df = mb52_df[~mb52_df['customer_order_number'].isna()][['customer_order_number', 'customer_order_position', 'delivery_plant', 'mat_number', 'stock_quantity']].copy()
-    mb52_general_stocks_df = mb52_df[mb52_df['customer_order_number'].isna()][['delivery_plant', 'mat_number', 'stock_quantity']].copy()
-    mb52_general_stocks_df = mb52_general_stocks_df.groupby(['mat_number', 'delivery_plant'], as_index=False).agg({"stock_quantity": "sum"})
+    mb52_special_stocks_df = upcast_floats(mb52_df[~mb52_df['customer_order_number'].isna()][['customer_order_number', 'customer_order_position', 'delivery_plant', 'mat_number', 'stock_quantity']]).copy()
+    mb52_general_stocks_df = upcast_floats(mb52_df[mb52_df['customer_order_number'].isna()][['delivery_plant', 'mat_number', 'stock_quantity']]).copy()
+    mb52_general_stocks_df = mb52_general_stocks_df.groupby(['mat_number', 'delivery_plant'], as_index=False, observed=True).agg({"stock_quantity": "sum"})
 
     agg_dict = {
         col: 'sum' if pd.api.types.is_numeric_dtype(zsdkap_zsbe_mb5t_merged_df[col]) else 'first'
@@ -293,7 +433,7 @@ def calculate_order_level_KPI(horizons=None,
         zsdkap_zsbe_mb5t_merged_df[
             zsdkap_zsbe_mb5t_merged_df['special_stock_indicator'] == 'general_stock'
             ]
-        .groupby(['mat_number', 'delivery_plant'], as_index=False)
+        .groupby(['mat_number', 'delivery_plant'], as_index=False, observed=True)
         .agg(agg_dict)
     )
 
@@ -322,139 +462,442 @@ def calculate_order_level_KPI(horizons=None,
     merged.loc[mask, ['customer_order_number', 'customer_order_position']] = 'grouped_orders'
 
     merged['stock_quantity'] = merged['stock_quantity'].replace('', pd.NA).fillna(0)
-    merged['to_be_produced_all'] = merged.apply(calculate_to_be_produced_all, axis=1)
 
-    merged['to_be_produced_gr_c'] = merged.apply(calculate_to_be_produced_gr_c, axis=1)
-    for h in horizons:
-        merged[f'to_be_produced_gr_c_{h}_days'] = merged.apply(
-            calculate_to_be_produced_gr_c, col_suffix=f"_{h}_days", axis=1)
+    return merged
+
+
+def calculate_order_level_KPI(horizons=None,
+                              mrp_controller='L1K',
+                              mat_name='R4',
+                              ready_goods_storage_locs=('0004', '0005', 'FSC'),
+                              include_zkbp1_sb=False,
+                              zsdkap_raw_df=None,
+                              sources=None,
+                              line=None,
+                              detail_sink=None):
+    # Ensure mrp_controller is always a tuple
+    if not isinstance(mrp_controller, (list, tuple, set, pd.Series)):
+        mrp_controller = mrp_controller,
+
+    # Ensure mat_name is always a tuple
+    if not isinstance(mat_name, (list, tuple, set, pd.Series)):
+        mat_name = mat_name,
 
-    kpis = {"ORDERS LEVEL (ALL)": int(merged['to_be_produced_all'].sum()),
-            "ORDERS LEVEL (GR C)": int(merged['to_be_produced_gr_c'].sum())}
+    # create_paths(zsdkap_report_name, zsbe_report_name, mb5t_report_name, mb52_report_name, zkbp1_report_name)
+
+    horizons = horizons
+    with stage_timer(stage_log, 'line_merges', line=line) as merges_timer:
+        if sources is None:
+            sources = load_source_snapshot(ready_goods_storage_locs, include_zkbp1_sb)
+
+        # Row positions of the line in ZSDKAP / ZSBE, built once per run in kpis_loop
+        line_index = sources.get('line_index') if line is not None else None
+        zsdkap_rows = line_index['zsdkap'][line] if line_index else None
+        zsbe_rows = line_index['zsbe'][line] if line_index else None
+
+        zsdkap_merged_df = get_zsdkap_merged_df(horizons, mrp_controller, mat_name, zsdkap_raw_df, zsdkap_rows)
+
+        # zsdkap_merged_df.to_excel(r'excel_files\bq–issue–tests\zsdkap_merged_df.xlsx', index=False)
+        # categories - shared dictionaries in compact mode (see kpis_loop), zsbe_df gets its markers as plain strings
+        categories = sources.get('categories')
+        zsbe_df = to_compact(get_zsbe_df(mrp_controller, include_zkbp1_sb, mat_name, sources['zsbe'], sources['zkbp1'], zsbe_rows),
+                             categories)
+        mb5t_df = sources['mb5t']
+        mb52_df = sources['mb52']
+
+        # --incremental: only materials whose inputs changed since the previous run are merged and recalculated
+        incremental = sources.get('incremental') if line is not None else None
+        line_state = None
+        changed = None
+        if incremental:
+            line_state = LineState(incremental['state_dir'], incremental['department'], line,
+                                   {**incremental['settings'], 'mrp_controller': list(mrp_controller), 'mat_name': list(mat_name)})
+            changed = line_state.changed_mats({'zsdkap': zsdkap_merged_df, 'zsbe': zsbe_df, 'mb5t': mb5t_df, 'mb52': mb52_df})
+            zsdkap_merged_df, zsbe_df, mb5t_df, mb52_df = (only_mats(df, changed)
+                                                           for df in (zsdkap_merged_df, zsbe_df, mb5t_df, mb52_df))
+            merges_timer.fields['changed_mats'] = len(changed)
+
+        if line_state is not None and line_state.previous is not None and not changed:
+            merged = None
+        else:
+            merged = build_line_detail(zsdkap_merged_df, zsbe_df, mb5t_df, mb52_df)
+        merges_timer.fields['rows'] = 0 if merged is None else len(merged)
+
+    with stage_timer(stage_log, 'kpi_computation', line=line, rows=0 if merged is None else len(merged)):
+        if merged is not None:
+            merged = calculate_to_be_produced(merged, horizons)
+        if line_state is not None:
+            # Wiersze niezmienionych materiałów z poprzedniego przebiegu, KPI liczone z całości
+            merged = line_state.update(merged, changed)
 
-    for h in horizons:
-        kpis[f'ORDERS LEVEL (GR C - {h})'] = int(merged[f'to_be_produced_gr_c_{h}_days'].sum())
+        kpis = {"ORDERS LEVEL (ALL)": int(merged['to_be_produced_all'].sum()),
+                "ORDERS LEVEL (GR C)": int(merged['to_be_produced_gr_c'].sum())}
+
+        for h in horizons:
+            kpis[f'ORDERS LEVEL (GR C - {h})'] = int(merged[f'to_be_produced_gr_c_{h}_days'].sum())
 
     # merged.to_excel(r'excel_files\bq–issue–tests\merged_final.xlsx', index=False)
-    merged.to_excel(f"{OUTPUT_FILE_PATH}/output_{'_'.join(mrp_controller)}.xlsx")
+    if detail_sink is None:
+        detail_sink = XlsxDetailSink(OUTPUT_FILE_PATH)
+    with stage_timer(stage_log, 'detail_write', line=line, rows=len(merged), output=type(detail_sink).__name__):
+        detail_sink.write(merged, f"output_{'_'.join(mrp_controller)}", line)
     return kpis
 
 
-def kpis_loop(lines, mrp_controllers, product_names, zsdkap, zsbe, mb52, mb5t, horizons, storage_locs, result_file_sheet, include_zkbp1_sb=False, zkbp1_report_name="ZKBP1_SB_0301"):
-    try:
-        create_paths(zsdkap, zsbe, mb5t, mb52, zkbp1_report_name)
-        zsdkap_raw_df = load_open_orders_and_adjust_dispatch_date(ZSDKAP_FILE_PATH)
-        zsdkap_raw_df = fill_general_stock_information(zsdkap_raw_df)
+def save_kpis(department, result_file_sheet, kpis_results):
+    """
+    Results of a run go to the append-only KPI store, then (unless --no-excel) to the KPI workbook.
+    """
+    if not kpis_results:
+        return
 
-        for line, mrp, prd_name in zip(lines, mrp_controllers, product_names):
-            kpis_result = calculate_order_level_KPI(horizons=horizons, mrp_controller=mrp, mat_name=prd_name, ready_goods_storage_locs=storage_locs,
-                                                    include_zkbp1_sb= include_zkbp1_sb, zsdkap_raw_df=zsdkap_raw_df)
-            kpis_result["LINE"] = line
+    try:
+        with stage_timer(stage_log, 'kpi_store_write', rows=len(kpis_results)):
+            kpi_store = KpiStore()
+            try:
+                kpi_store.append(department or result_file_sheet, result_file_sheet, kpis_results)
+            finally:
+                kpi_store.close()
+    except Exception as e:
+        print("Błąd zapisu do KPI store: ", e)
 
-            append_data_to_excel(
+    if WRITE_EXCEL:
+        with stage_timer(stage_log, 'kpi_excel_write', rows=len(kpis_results)):
+            append_rows_to_excel(
                 status_file=KPIS_FILE_PATH,
-                data_dict=kpis_result,
+                data_dicts=kpis_results,
                 error_path=ERROR_PATH,
                 sheet_name=result_file_sheet
             )
+
+
+# Sources of a line worker process, set once by _init_line_worker
+_worker_zsdkap_raw_df = None
+_worker_sources = None
+_worker_detail_sink = None
+
+
+def _init_line_worker(frame_paths, shared_objects, output_file_path, detail_sink, tags):
+    global _worker_zsdkap_raw_df, _worker_sources, _worker_detail_sink, OUTPUT_FILE_PATH
+    # spawn: the worker starts with module defaults, paths set at runtime have to be passed in
+    OUTPUT_FILE_PATH = output_file_path
+    set_stage_tags(**tags)
+    _worker_detail_sink = detail_sink
+    frames = load_shared_frames(frame_paths)
+    _worker_zsdkap_raw_df = frames.pop('zsdkap')
+    _worker_sources = {**frames, **shared_objects}
+
+
+def _calculate_line_in_worker(task):
+    line, mrp, prd_name, horizons, storage_locs, include_zkbp1_sb = task
+    kpis_result = calculate_order_level_KPI(horizons=horizons, mrp_controller=mrp, mat_name=prd_name,
+                                            ready_goods_storage_locs=storage_locs, include_zkbp1_sb=include_zkbp1_sb,
+                                            zsdkap_raw_df=_worker_zsdkap_raw_df, sources=_worker_sources, line=line,
+                                            detail_sink=_worker_detail_sink)
+    kpis_result["LINE"] = line
+    return kpis_result
+
+
+def iter_lines_parallel(lines, mrp_controllers, product_names, horizons, storage_locs, include_zkbp1_sb,
+                        zsdkap_raw_df, sources, workers=LINE_WORKERS, detail_sink=None, department=None):
+    """
+    Calculates lines in worker processes and yields their KPI dicts in line order. ZSDKAP and the source
+    frames are written once to Arrow files (shared_frames) and loaded once per worker, not pickled per task -
+    only the small task tuples, the line index and the KPI dicts go through pickling. Every worker holds its
+    own copy of the frames, so memory grows with the number of workers.
+
+    :param detail_sink: sink of the run - workers get its for_workers() side, spooled details are taken over
+                        in line order (e.g. sheets of a single workbook)
+    """
+    if detail_sink is None:
+        detail_sink = XlsxDetailSink(OUTPUT_FILE_PATH)
+
+    # categories / line_index are small dicts, everything else in sources is a frame (or None)
+    shared_objects = {name: value for name, value in sources.items() if isinstance(value, dict)}
+    frames = {'zsdkap': zsdkap_raw_df, **{name: df for name, df in sources.items() if name not in shared_objects}}
+    tasks = [(line, mrp, prd_name, horizons, storage_locs, include_zkbp1_sb)
+             for line, mrp, prd_name in zip(lines, mrp_controllers, product_names)]
+
+    with shared_frames(frames) as frame_paths:
+        # spawn również na Linuksie - to samo zachowanie co na Windows, bez forka procesu z wątkami RFC
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_line_worker,
+                                 initargs=(frame_paths, shared_objects, OUTPUT_FILE_PATH, detail_sink.for_workers(),
+                                           {'department': department})) as executor:
+            for kpis_result in executor.map(_calculate_line_in_worker, tasks):
+                detail_sink.take_spooled(kpis_result["LINE"])
+                yield kpis_result
+
+
+def load_zsdkap_raw_df(file_path, mrp_controllers=None, product_names=None):
+    # Only rows that can belong to one of the lines are kept
+    zsdkap_raw_df = load_open_orders_and_adjust_dispatch_date(file_path, mrp_controllers, product_names)
+    return fill_general_stock_information(zsdkap_raw_df)
+
+
+def kpis_loop(lines, mrp_controllers, product_names, zsdkap, zsbe, mb52, mb5t, horizons, storage_locs, result_file_sheet, include_zkbp1_sb=False, zkbp1_report_name="ZKBP1_SB_0301",
+              zsdkap_raw_df=None, department=None):
+    """
+    :param zsdkap_raw_df: enriched ZSDKAP shared between departments (see run_departments) - DataFrame,
+                          Future still loading it, or None to load it here
+    """
+    try:
+        create_paths(zsdkap, zsbe, mb5t, mb52, zkbp1_report_name)
+
+        # Source exports and the EKKN lookup are read in threads while ZSDKAP + VBAP is loading,
+        # both are joined only here, before the KPI stage
+        with ThreadPoolExecutor(max_workers=SOURCE_IO_WORKERS) as executor:
+            source_futures = submit_source_snapshot(executor, storage_locs, include_zkbp1_sb)
+            if zsdkap_raw_df is None:
+                zsdkap_raw_df = load_zsdkap_raw_df(ZSDKAP_FILE_PATH, mrp_controllers, product_names)
+            elif isinstance(zsdkap_raw_df, Future):
+                zsdkap_raw_df = zsdkap_raw_df.result()
+            sources = collect_source_snapshot(source_futures)
+
+        if COMPACT_DTYPES:
+            categories = build_shared_categories([zsdkap_raw_df, *sources.values()])
+            zsdkap_raw_df = to_compact(zsdkap_raw_df, categories)
+            sources = {name: to_compact(df, categories) for name, df in sources.items()}
+            sources['categories'] = categories
+
+        # Line -> row positions, lines then take their rows instead of scanning both frames each
+        sources['line_index'] = {
+            'zsdkap': build_line_index(zsdkap_raw_df, lines, mrp_controllers, product_names),
+            'zsbe': build_line_index(sources['zsbe'], lines, mrp_controllers, product_names),
+        }
+
+        if INCREMENTAL:
+            # Per-line state of the previous run (see incremental.LineState)
+            sources['incremental'] = {
+                'state_dir': str(INCREMENTAL_STATE_DIR),
+                'department': department or result_file_sheet,
+                'settings': {'horizons': list(horizons), 'storage_locs': list(storage_locs),
+                             'include_zkbp1_sb': include_zkbp1_sb, 'compact': COMPACT_DTYPES},
+            }
+
+        # KPI rows of all lines are written in one go; lines finished before an error are still saved
+        kpis_results = []
+        detail_sink = make_detail_sink(DETAIL_OUTPUT, OUTPUT_FILE_PATH, f"output_{department or result_file_sheet}")
+        try:
+            if LINE_WORKERS > 1 and len(lines) > 1:
+                for kpis_result in iter_lines_parallel(lines, mrp_controllers, product_names, horizons, storage_locs,
+                                                       include_zkbp1_sb, zsdkap_raw_df, sources, LINE_WORKERS, detail_sink,
+                                                       department):
+                    kpis_results.append(kpis_result)
+            else:
+                for line, mrp, prd_name in zip(lines, mrp_controllers, product_names):
+                    kpis_result = calculate_order_level_KPI(horizons=horizons, mrp_controller=mrp, mat_name=prd_name, ready_goods_storage_locs=storage_locs,
+                                                            include_zkbp1_sb= include_zkbp1_sb, zsdkap_raw_df=zsdkap_raw_df,
+                                                            sources=sources, line=line, detail_sink=detail_sink)
+                    kpis_result["LINE"] = line
+                    kpis_results.append(kpis_result)
+        finally:
+            # KPI zapisywane także wtedy, gdy zamknięcie detail output się nie uda (np. skoroszyt otwarty w Excelu)
+            try:
+                detail_sink.close()
+            finally:
+                save_kpis(department, result_file_sheet, kpis_results)
     except Exception as e:
         print("Błąd: ", e)
         error_details = traceback.format_exc()
         print("Szczegóły błędu:\n", error_details)
+        if not PAUSE_ON_ERROR:
+            raise
         input("Press Enter...")
 
 
-def wmo_kpis():
-    today = datetime.today()
-    today_str = today.strftime('%Y-%m-%d')
-
+DEPARTMENTS = {
+    'wmo': {
+        'zsbe': 'zsbe_wmo',
+        'mb52': 'mb52',
+        'mb5t': "MB5TD_2101",
+        'result_file_sheet': "LUB",
+        'storage_locs': ('0004', '0005', 'FSC'),
+        'horizons': [3, 5, 10],
+        'lines': ["P100", "M200", "M300", "M320", "M500", "M600", "MDA", "ASA"],
+        'mrp_controllers': ['L1K', ('L1H', 'L41', 'L3H', 'L82', 'L11'), ('L3H', 'L82', 'L11'), ('L2H', 'L11'), 'LD1', 'LZ1', 'LMD', 'LAS'],
+        'product_names': [('R4', 'R7', 'R3', 'R5', 'EFL_R4', 'EFL_R7'), ('R4', 'R7', 'R3', 'R5', 'EFL_R4', 'EFL_R7', 'EFL 4', 'EFL 7'), ('R6', 'R8', 'EFL_R6', 'EFL_R8', 'EFL 6', 'EFL 8'), ('Q4', 'EFL_Q'), 'R2', ('ZI', 'KO', 'Li'), ('MDA'), ('ASA', 'ASI')],  # Product names starts with...
+        # 'lines': ["MDA"],
+        # 'mrp_controllers': [('LMD')],
+        # 'product_names': [('MDA')],  # Product names starts with...
+        'include_zkbp1_sb': False,
+    },
+    'wmr': {
+        'zsbe': 'zsbe_wmr',
+        'mb52': 'mb52',
+        'mb5t': "MB5TD_2101",
+        'result_file_sheet': "LUB",
+        'storage_locs': ('0004', '0005', 'FSC', '0003'),
+        'horizons': [3, 5, 10],
+        'lines': ["ZRV", "ZJA", "ZFA", "ZRI", "ZAR"],
+        'mrp_controllers': [('L2E', 'L2V', 'LI1', 'LI3'), ('L2J', 'LI5', 'LI8', 'L2S'), ('L2F', 'LI6'), 'L2I', ('L2B', 'L2R', 'LI2', 'LI4', 'LI7')],
+        'product_names': [('ZRE_M', 'ZRE M', 'ZRV_M', 'ZRV M'), ('ZJA', 'ZRE_E', 'ZRE E', 'ZRV_E', 'ZRV E'), 'ZFA', 'ZRI', ('ZAR', 'Auss', 'BHG', 'ZRS')],  # Product names starts with...
+        'include_zkbp1_sb': False,
+    },
+    # BMH KPIs
+    'mont': {
+        'zsbe': 'zsbe_mont',
+        'mb52': 'mb52',
+        'mb5t': "MB5TD_0301",
+        'zkbp1_report_name': "ZKBP1_SB_0301",
+        'result_file_sheet': "LUB",
+        'storage_locs': ('0004', '0005', 'FSC', '0003', '0007'),
+        'horizons': [3, 5, 10],
+        'lines': ["WDF68K", "WDFQK", "ZRO", "QR1", "EDR"],
+        'mrp_controllers': [
+            ('M81', 'M82', 'M8M', 'M84', 'M71', 'M72'),
+            ('MQ1', 'MQ2', 'MQ4', 'MNW'),
+            ('MR1', 'MR2', 'MR3', 'M8M', 'MRR'),
+            "MR4",
+            ('MEB', 'MED', 'MEE', 'MEI', 'MEH', 'MEJ', 'MEM', 'MEN', 'MEX')
+        ],
+        # Product names starts with...
+        'product_names': [
+            ('R6', 'R8', 'I8', 'EFL', 'ABR'),
+            ('Q4', 'QRA', 'Qt4', 'EFL', 'ABR'),
+            ('ZRO', 'ZMA'),
+            "ZRO",
+            ('ED', 'EF', 'EA')
+        ],
+        'include_zkbp1_sb': True,
+    },
+}
+
+
+def department_kpis(department, zsdkap_raw_df=None):
     zsdkap = generate_zsdkap_filename()
-    zsbe = 'zsbe_wmo'
-    mb52 = 'mb52'
-    mb5t = "MB5TD_2101"
-    result_sheet = "LUB"
+    with stage_tags(department=department), stage_timer(stage_log, 'department', lines=len(DEPARTMENTS[department]['lines'])):
+        kpis_loop(zsdkap=zsdkap, zsdkap_raw_df=zsdkap_raw_df, department=department, **DEPARTMENTS[department])
 
-    storage_locs = ('0004', '0005', 'FSC')
 
-    horizons = [3, 5, 10]
+def wmo_kpis(zsdkap_raw_df=None):
+    department_kpis('wmo', zsdkap_raw_df)
 
-    lines = ["P100", "M200", "M300", "M320", "M500", "M600", "MDA", "ASA"]
-    mrp_controllers = ['L1K', ('L1H', 'L41', 'L3H', 'L82', 'L11'), ('L3H', 'L82', 'L11'), ('L2H', 'L11'), 'LD1', 'LZ1', 'LMD', 'LAS']
-    product_names = [('R4', 'R7', 'R3', 'R5', 'EFL_R4', 'EFL_R7'), ('R4', 'R7', 'R3', 'R5', 'EFL_R4', 'EFL_R7', 'EFL 4', 'EFL 7'), ('R6', 'R8', 'EFL_R6', 'EFL_R8', 'EFL 6', 'EFL 8'), ('Q4', 'EFL_Q'), 'R2', ('ZI', 'KO', 'Li'), ('MDA'), ('ASA', 'ASI')]  # Product names starts with...
 
-    # lines = ["MDA"]
-    # mrp_controllers = [('LMD')]
-    # product_names = [('MDA')]  # Product names starts with...
-    kpis_loop(lines, mrp_controllers, product_names, zsdkap, zsbe, mb52, mb5t, horizons, storage_locs, result_sheet, False)
+def wmr_kpis(zsdkap_raw_df=None):
+    department_kpis('wmr', zsdkap_raw_df)
 
-def wmr_kpis():
-    today = datetime.today()
-    today_str = today.strftime('%Y-%m-%d')
-
-    zsdkap = generate_zsdkap_filename()
-    zsbe = 'zsbe_wmr'
-    mb52 = 'mb52'
-    mb5t = "MB5TD_2101"
-    result_sheet = "LUB"
 
-    storage_locs = ('0004', '0005', 'FSC', '0003')
-
-    horizons = [3, 5, 10]
-
-    lines = ["ZRV", "ZJA", "ZFA", "ZRI", "ZAR"]
-    mrp_controllers = [('L2E', 'L2V', 'LI1', 'LI3'), ('L2J', 'LI5', 'LI8', 'L2S'), ('L2F', 'LI6'), 'L2I', ('L2B', 'L2R', 'LI2', 'LI4', 'LI7')]
-    product_names = [('ZRE_M', 'ZRE M', 'ZRV_M', 'ZRV M'), ('ZJA', 'ZRE_E', 'ZRE E', 'ZRV_E', 'ZRV E'), 'ZFA', 'ZRI', ('ZAR', 'Auss', 'BHG', 'ZRS')]  # Product names starts with...
-
-    kpis_loop(lines, mrp_controllers, product_names, zsdkap, zsbe, mb52, mb5t, horizons, storage_locs, result_sheet, False)
-
-def mont_kpis():
+def mont_kpis(zsdkap_raw_df=None):
     '''
     BMH KPIs
     '''
-    today = datetime.today()
-    today_str = today.strftime('%Y-%m-%d')
+    department_kpis('mont', zsdkap_raw_df)
+
 
+def run_departments(departments):
+    """
+    Runs several departments in one process. The ZSDKAP export is loaded, enriched with VBAP delivery plants
+    and dispatch-date adjusted only once, then every department's lines are calculated against it.
+    The load runs in the background, so the first department reads its own sources in the meantime.
+    """
     zsdkap = generate_zsdkap_filename()
-    zsbe = 'zsbe_mont'
-    mb52 = 'mb52'
-    mb5t = "MB5TD_0301"
-    zkbp1_report_name = "ZKBP1_SB_0301"
-    result_sheet = "LUB"
-
-    storage_locs = ('0004', '0005', 'FSC', '0003', '0007')
-
-    horizons = [3, 5, 10]
-
-    lines = ["WDF68K", "WDFQK", "ZRO", "QR1", "EDR"]
-    mrp_controllers = [
-        ('M81', 'M82', 'M8M', 'M84', 'M71', 'M72'),
-        ('MQ1', 'MQ2', 'MQ4', 'MNW'),
-        ('MR1', 'MR2', 'MR3', 'M8M', 'MRR'),
-        "MR4",
-        ('MEB', 'MED', 'MEE', 'MEI', 'MEH', 'MEJ', 'MEM', 'MEN', 'MEX')
-    ]
-
-    product_names = [
-        ('R6', 'R8', 'I8', 'EFL', 'ABR'),
-        ('Q4', 'QRA', 'Qt4', 'EFL', 'ABR'),
-        ('ZRO', 'ZMA'),
-        "ZRO",
-        ('ED', 'EF', 'EA')
-    ]
-    # Product names starts with...
-
-    kpis_loop(lines, mrp_controllers, product_names, zsdkap, zsbe, mb52, mb5t, horizons, storage_locs, result_sheet,
-              True, zkbp1_report_name)
+    first = DEPARTMENTS[departments[0]]
+    create_paths(zsdkap, first['zsbe'], first['mb5t'], first['mb52'], first.get('zkbp1_report_name', "ZKBP1_SB_0301"))
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Shared load - logged with all departments as the department tag
+        with stage_tags(department='+'.join(departments)):
+            zsdkap_context = contextvars.copy_context()
+        zsdkap_future = executor.submit(
+            zsdkap_context.run,
+            load_zsdkap_raw_df,
+            ZSDKAP_FILE_PATH,
+            [mrp for department in departments for mrp in DEPARTMENTS[department]['mrp_controllers']],
+            [prd_name for department in departments for prd_name in DEPARTMENTS[department]['product_names']],
+        )
+
+        for department in departments:
+            department_kpis(department, zsdkap_future)
+            # Błąd ZSDKAP/VBAP został już zgłoszony przez kpis_loop - pozostałe działy nie mają danych
+            if zsdkap_future.exception() is not None:
+                return
+
+
+def parse_departments(args):
+    departments = []
+    for arg in args:
+        for name in arg.split(','):
+            name = name.strip().lower()
+            if not name:
+                continue
+            if name == 'all':
+                departments.extend(DEPARTMENTS)
+            elif name in DEPARTMENTS:
+                departments.append(name)
+            else:
+                raise SystemExit(f"Nieznany dział: {name!r} (dostępne: {', '.join(DEPARTMENTS)}, all)")
+
+    # Keep order, drop repeats (e.g. "all wmo")
+    return list(dict.fromkeys(departments))
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PPS KPIs")
+    parser.add_argument('departments', nargs='*',
+                        help="wmo, wmr, mont, all - or several of them, e.g. 'wmo wmr' / 'wmo,mont'")
+    parser.add_argument('--refresh-rfc-cache', action='store_true',
+                        help="ignore cached VBAP/EKKN results and read every key from SAP again")
+    parser.add_argument('--compact', action='store_true',
+                        help="keep key columns as shared categoricals and quantities as float32 (less memory, faster merges)")
+    parser.add_argument('--no-excel', action='store_true',
+                        help="store results only in the KPI store, do not touch the KPI workbook")
+    parser.add_argument('--rebuild-excel', action='store_true',
+                        help="regenerate the KPI sheet(s) from the KPI store (after the run, if departments are given)")
+    parser.add_argument('--import-excel', action='store_true',
+                        help="one-off: copy the records already in the KPI sheet(s) into the KPI store")
+    parser.add_argument('--line-workers', type=int, default=LINE_WORKERS,
+                        help="calculate lines in N worker processes (default: 1 = one after another)")
+    parser.add_argument('--detail-output', choices=DETAIL_OUTPUT_MODES, default=DETAIL_OUTPUT,
+                        help="per-line detail output: xlsx (default), csv, parquet, workbook (one file per run), none")
+    parser.add_argument('--profile', nargs='?', const=f"pps_kpi_{datetime.now():%Y%m%d_%H%M%S}.prof", metavar='STATS_FILE',
+                        help="run under cProfile and dump the stats (default: logs/pps_kpi_<timestamp>.prof)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="recalculate only materials whose ZSDKAP / ZSBE / MB5TD / MB52 rows changed since the previous "
+                             "--incremental run, take the other rows over")
+    parser.add_argument('--non-interactive', action='store_true',
+                        help="do not wait for Enter after an error, exit with an error instead (scheduled runs)")
+    parser.add_argument('--rfc-mode', choices=RFC_MODES, default='live',
+                        help="live (default), record - save every RFC call to the archive, replay - answer RFC calls "
+                             "from the archive without SAP")
+    parser.add_argument('--rfc-archive', default=str(RFC_ARCHIVE_PATH),
+                        help=f"archive of recorded RFC calls (default: {RFC_ARCHIVE_PATH})")
+    parser.add_argument('--rfc-replay-latency', metavar='SECONDS|recorded',
+                        help="replay: wait SECONDS per call or as long as the recorded call took (default: no wait)")
+    args = parser.parse_args()
+
+    RFC_FORCE_REFRESH = args.refresh_rfc_cache
+    COMPACT_DTYPES = args.compact
+    WRITE_EXCEL = not args.no_excel
+    LINE_WORKERS = args.line_workers
+    DETAIL_OUTPUT = args.detail_output
+    INCREMENTAL = args.incremental
+    PAUSE_ON_ERROR = not args.non_interactive
+
+    if args.rfc_mode != 'live':
+        # Nagrywane i odtwarzane są dokładnie te same zapytania - lokalny cache VBAP/EKKN nie może ich zmieniać
+        RFC_CACHE_ENABLED = False
+        set_rfc_mode(args.rfc_mode, args.rfc_archive, parse_replay_latency(args.rfc_replay_latency))
+
+    selected = parse_departments(args.departments)
+    if not (selected or args.rebuild_excel or args.import_excel):
+        parser.error("podaj dział (wmo, wmr, mont, all) albo --rebuild-excel / --import-excel")
+
+    # Arkusze wybranych działów (bez działów - wszystkie)
+    sheets = list(dict.fromkeys(DEPARTMENTS[d]['result_file_sheet'] for d in (selected or DEPARTMENTS)))
+
+    if args.import_excel:
+        kpi_store = KpiStore()
+        for sheet in sheets:
+            kpi_store.import_excel(KPIS_FILE_PATH, sheet)
+        kpi_store.close()
+
+    if selected:
+        if args.profile:
+            run_profiled(args.profile, run_departments, selected)
+        else:
+            run_departments(selected)
 
-    department = sys.argv[1]
-    if department == 'wmo':
-        wmo_kpis()
-    elif department == 'wmr':
-        wmr_kpis()
-    elif department == 'mont':
-        mont_kpis()
-    # mont_kpis()
-    # wmo_kpis()
-    # wmr_kpis()
+    if args.rebuild_excel:
+        for sheet in sheets:
+            rebuild_excel(KPIS_FILE_PATH, sheet, ERROR_PATH)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional, Any
+
+import pandas as pd
+
+from cache_config import EXCEL_CACHE_DIR, EXCEL_CACHE_ENABLED
+from log_utils import setup_logger, warn_once
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+log = setup_logger("EXCEL_CACHE", "excel_cache.log")
+
+
+def file_fingerprint(path: str) -> str:
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+
+
+def _digest(value: Any) -> str:
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def _cache_file(path: str, sheet_name: str, dtype: Optional[Dict[str, Any]]) -> Path:
+    # <nazwa>_<źródło: ścieżka + arkusz + dtype>_<wersja: rozmiar + mtime>
+    source = _digest([os.path.abspath(path), sheet_name, {k: str(v) for k, v in (dtype or {}).items()}])
+    version = _digest(file_fingerprint(path))
+    return EXCEL_CACHE_DIR / f"{Path(path).stem}_{source}_{version}.parquet"
+
+
+def _drop_stale_entries(cache_file: Path) -> None:
+    # Tylko starsze wersje tego samego źródła - eksport o tej samej nazwie w innym katalogu ma inny digest
+    prefix = cache_file.stem.rsplit("_", 1)[0]
+    for old in cache_file.parent.glob(f"{prefix}_*.parquet"):
+        if old != cache_file and old.stem.rsplit("_", 1)[0] == prefix:
+            try:
+                old.unlink()
+            except OSError as e:
+                log.warning("Nie można usunąć starego pliku cache %s: %s", old, e)
+
+
+def read_excel_cached(
+    path: str,
+    sheet_name: str,
+    dtype: Optional[Dict[str, Any]] = None,
+    use_cache: bool = EXCEL_CACHE_ENABLED,
+) -> pd.DataFrame:
+    """
+    Reads an SAP Excel export through a local Parquet cache.
+
+    The cache entry is keyed by path + size + mtime of the workbook (and the requested sheet/dtypes),
+    so a new export on the share invalidates it automatically. Without pyarrow it falls back to read_excel.
+    """
+    if use_cache and not HAS_PYARROW:
+        warn_once(log, "Brak pyarrow - cache Excela wyłączony, eksporty czytane przez read_excel przy każdym uruchomieniu "
+                       "(pip install -r requirements.txt)")
+    if not use_cache or not HAS_PYARROW:
+        return pd.read_excel(path, sheet_name=sheet_name, dtype=dtype)
+
+    cache_file = _cache_file(path, sheet_name, dtype)
+
+    if cache_file.exists():
+        try:
+            df = pd.read_parquet(cache_file, memory_map=True)
+            log.info("Cache hit: %s -> %s", path, cache_file.name)
+            return df
+        except Exception as e:
+            log.warning("Uszkodzony plik cache %s, czytam Excel ponownie: %s", cache_file, e)
+
+    df = pd.read_excel(path, sheet_name=sheet_name, dtype=dtype)
+
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        df.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, cache_file)
+        _drop_stale_entries(cache_file)
+        log.info("Cache zapisany: %s -> %s", path, cache_file.name)
+    except Exception as e:
+        log.warning("Nie można zapisać cache dla %s: %s", path, e)
+
+    return df
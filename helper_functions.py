@@ -1,11 +1,22 @@
 import logging
+import os
+import re
+import socket
+import threading
+import time
 
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
 
 import pandas as pd
 from openpyxl import load_workbook
 from openpyxl.styles import Border, Alignment
 
+from log_utils import setup_logger
+from maps import compact_category_domains, compact_category_sentinels
+
+lock_log = setup_logger("FILE_LOCK", "file_lock.log")
+
 
 def copy_row_format(ws, source_row, target_row):
     """
@@ -37,73 +48,237 @@ def copy_row_format(ws, source_row, target_row):
             target_cell.alignment = new_alignment
 
 
-def append_data_to_excel(status_file, data_dict, error_path, sheet_name):
+def _pid_alive(pid):
+    if os.name == 'nt':
+        # os.kill(pid, 0) na Windows zabija proces - zamiast tego OpenProcess + GetExitCodeProcess
+        import ctypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return ctypes.get_last_error() == 5  # ERROR_ACCESS_DENIED - proces istnieje
+        try:
+            exit_code = ctypes.c_ulong()
+            return not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)) or exit_code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _lock_is_stale(owner, age, stale_after):
     """
-    Appends a new row to the given sheet in the given Excel file using the status_dict.
+    Lock left by a crashed run: its process no longer exists (owner on this host) or its owner stopped refreshing it
+    (mtime older than stale_after - a live owner touches the lock every few seconds, see file_lock).
+
+    :param owner: str: Content of the lock file ("<host> pid=<pid> <timestamp>")
+    """
+    match = re.match(r"(\S+) pid=(\d+) ", owner)
+    if match and match.group(1) == socket.gethostname() and not _pid_alive(int(match.group(2))):
+        return True
+
+    return age > stale_after
+
+
+def _take_over_stale_lock(path, stale_after):
+    """
+    Removes a stale lock file. It is first renamed to a name unique to this process - only one waiter can rename it,
+    the others find no lock file and go back to O_EXCL. Returns True if this process removed it.
+    """
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            owner = f.read()
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return False  # lock released in the meantime
+    if not _lock_is_stale(owner, age, stale_after):
+        return False
+
+    claimed = f"{path}.{socket.gethostname()}.{os.getpid()}.stale"
+    try:
+        os.rename(path, claimed)
+    except OSError:
+        return False  # taken over (or released) by another waiter first
+
+    with open(claimed, encoding="utf-8", errors="replace") as f:
+        renamed_owner = f.read()
+    renamed_age = time.time() - os.path.getmtime(claimed)
+    if renamed_owner != owner or not _lock_is_stale(renamed_owner, renamed_age, stale_after):
+        # Między odczytem a rename inny proces przejął blokadę albo właściciel ją odświeżył - oddajemy ją
+        if not os.path.exists(path):
+            os.rename(claimed, path)
+        return False
+
+    os.remove(claimed)
+    lock_log.warning("Stale lock %s taken over (owner: %s, not refreshed for %.0f s)", path, owner.strip() or "unknown", age)
+    return True
+
+
+def _refresh_lock(path, stop, interval):
+    # Heartbeat właściciela - mtime blokady świeży tak długo, jak proces żyje (także przy długim --rebuild-excel)
+    while not stop.wait(interval):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+
+@contextmanager
+def file_lock(path, timeout=300, stale_after=120, poll_interval=1.0, heartbeat_interval=10.0):
+    """
+    Exclusive lock based on a lock file created with O_EXCL (works on network shares, e.g. P:).
+    The lock file holds host and pid of its owner, a heartbeat thread refreshes its mtime while it is held.
+    A lock whose process is gone (same host) or that was not refreshed for stale_after seconds (owner crashed
+    on any host) is taken over - stale_after is kept below timeout, so a crashed run does not make the next
+    runs time out, and well above heartbeat_interval, so a live owner never loses the lock.
+
+    :param path: str: Path of the lock file
+    :param timeout: int: Seconds to wait for the lock before TimeoutError
+    :param stale_after: int: Seconds without a heartbeat after which a lock is stale
+    :param heartbeat_interval: float: Seconds between mtime refreshes of a held lock
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if _take_over_stale_lock(path, stale_after):
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Lock {path} held by another run for more than {timeout} s")
+            time.sleep(poll_interval)
+
+    stop_heartbeat = threading.Event()
+    heartbeat = threading.Thread(target=_refresh_lock, args=(path, stop_heartbeat, heartbeat_interval), daemon=True)
+    try:
+        os.write(fd, f"{socket.gethostname()} pid={os.getpid()} {datetime.now():%Y-%m-%d %H:%M:%S}".encode())
+        os.close(fd)
+        heartbeat.start()
+        yield
+    finally:
+        stop_heartbeat.set()
+        if heartbeat.is_alive():
+            heartbeat.join()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def find_append_row(ws):
+    """
+    First row after the last filled date in column A. Rows are always written as one contiguous block,
+    so scanning column A from the bottom only passes the empty framed rows, not the whole sheet.
+
+    :param ws: Worksheet object
+    :return: int: Row number for the next record
+    """
+    row = ws.max_row
+    while row > 1 and ws.cell(row=row, column=1).value in (None, ""):
+        row -= 1
+
+    return row + 1
+
+
+def append_rows_to_excel(status_file, data_dicts, error_path, sheet_name, lock_timeout=300, dates=None, replace=False):
+    """
+    Appends one row per dictionary to the given sheet - one load, one insert and one save for the whole batch.
+    The workbook is written under a lock file and saved through a temporary file, so concurrent department
+    runs neither corrupt it nor overwrite each other's rows.
 
-    :param sheet_name: sheet_name of excel status file
-    :param error_path: path to error file
     :param status_file: str: Path to the Excel file
-    :param data_dict: dict: Dictionary containing status messages
+    :param data_dicts: list: Dictionaries with KPI values (keys matching headers)
+    :param error_path: path to error file
+    :param sheet_name: sheet_name of excel status file
+    :param lock_timeout: int: Seconds to wait for another run to finish writing
+    :param dates: list: Date for column A of each row (default: today for all rows)
+    :param replace: bool: Remove all existing records first (regenerating the sheet, see kpi_store.rebuild_excel)
     """
     logging.basicConfig(
         filename=error_path,
         level=logging.ERROR,
         format="%(asctime)s - %(levelname)s - %(message)s",
     )
+    if not data_dicts:
+        return
+
     try:
-        # Load the existing workbook
-        wb = load_workbook(status_file)
+        with file_lock(f"{status_file}.lock", timeout=lock_timeout):
+            # Load the existing workbook
+            wb = load_workbook(status_file)
 
-        # Select the "MRP_STOCKS" sheet
-        if sheet_name not in wb.sheetnames:
-            print(f"Error: Sheet '{sheet_name}' not found in the Excel file.")
-            return
+            if sheet_name not in wb.sheetnames:
+                print(f"Error: Sheet '{sheet_name}' not found in the Excel file.")
+                return
 
-        ws = wb[sheet_name]
+            ws = wb[sheet_name]
 
-        # Get headers from the first row
-        headers = [ws.cell(row=1, column=col).value for col in range(1, ws.max_column + 1)]
+            # Get headers from the first row
+            headers = [ws.cell(row=1, column=col).value for col in range(1, ws.max_column + 1)]
 
-        # Find the first empty row within the framed area
-        first_empty_row = None
-        for row in range(2, ws.max_row + 1):  # Start from row 2 to skip headers
-            if all(ws.cell(row=row, column=col).value in [None, ""] for col in range(1, ws.max_column + 1)):
-                first_empty_row = row
-                break
+            first_row = find_append_row(ws)
+
+            if replace and first_row > 2:
+                ws.delete_rows(2, first_row - 2)
+                first_row = 2
 
-        # If no empty row is found, insert at the end
-        if first_empty_row is None:
-            first_empty_row = ws.max_row + 1
+            # Insert all new rows at once (the framed empty rows below move down)
+            ws.insert_rows(first_row, amount=len(data_dicts))
 
-        # Insert new data at the first empty row
-        ws.insert_rows(first_empty_row)
+            if dates is None:
+                dates = [datetime.today().strftime('%Y-%m-%d')] * len(data_dicts)
 
-        # Copy border formatting from the row above
-        if first_empty_row > 2:  # Ensure it's not the header row
-            copy_row_format(ws, first_empty_row - 1, first_empty_row)
+            # Border formatting from the row above the block, right under the header from the framed row below it
+            format_row = first_row - 1 if first_row > 2 else first_row + len(data_dicts)
 
-        today = datetime.today()
-        today_str = today.strftime('%Y-%m-%d')
+            for row, (data_dict, date_str) in enumerate(zip(data_dicts, dates), start=first_row):
+                copy_row_format(ws, format_row, row)
 
-        # Add date in column A
-        ws.cell(row=first_empty_row, column=1, value=today_str)
+                # Add date in column A
+                ws.cell(row=row, column=1, value=date_str)
 
-        # Fill in values based on dictionary keys matching headers
-        for col, header in enumerate(headers[1:], start=2):  # Start from column 2 (B) as A is for timestamp
-            ws.cell(row=first_empty_row, column=col, value=str(data_dict.get(header, "")))
+                # Fill in values based on dictionary keys matching headers
+                for col, header in enumerate(headers[1:], start=2):  # Start from column 2 (B) as A is for timestamp
+                    ws.cell(row=row, column=col, value=str(data_dict.get(header, "")))
 
-        # Append the row and save the file
-        wb.save(status_file)
+            # Save next to the target and swap - a failed save leaves the original file intact
+            tmp_file = f"{status_file}.{os.getpid()}.tmp.xlsx"
+            try:
+                wb.save(tmp_file)
+                os.replace(tmp_file, status_file)
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
 
-        print(f"KPIs updated successfully - {data_dict['LINE']}!")
+        for data_dict in data_dicts:
+            print(f"KPIs updated successfully - {data_dict['LINE']}!")
 
     except Exception as e:
         logging.error("Error occurred", exc_info=True)
         print("Error occurred: ", e)
+        if isinstance(e, TimeoutError):
+            print("Rows were not written to the workbook - they are in the KPI store, recover them with --rebuild-excel")
         print(f"Check {error_path} file for details")
 
 
+def append_data_to_excel(status_file, data_dict, error_path, sheet_name):
+    """
+    Appends a new row to the given sheet in the given Excel file using the status_dict.
+
+    :param sheet_name: sheet_name of excel status file
+    :param error_path: path to error file
+    :param status_file: str: Path to the Excel file
+    :param data_dict: dict: Dictionary containing status messages
+    """
+    append_rows_to_excel(status_file, [data_dict], error_path, sheet_name)
+
+
 def get_nth_working_day(num_of_days: int) -> pd.Timestamp:
     """
     Returns the n-th working day (as pandas.Timestamp)
@@ -131,6 +306,90 @@ def clean_number(value):
         return None  # W przypadku błędów (np. inne wartości) zwróć NaN
 
 
+def parse_polish_numbers(values):
+    """
+    Vectorized version of clean_number for a whole column in Polish locale format
+    ("1.234,5", "1 234,5" -> 1234.5).
+
+    :param values: Series/array of strings
+    :return: tuple: (float Series - NaN for blank or invalid values, number of non-blank values that failed to parse)
+    """
+    text = pd.Series(values, copy=False).astype(object).fillna('').astype(str).str.strip()
+    # Separatory tysięcy (kropka, spacja, twarda spacja) -> usunięte, przecinek dziesiętny -> kropka
+    normalized = text.str.replace(r'[.\s\u00a0]', '', regex=True).str.replace(',', '.', regex=False)
+    parsed = pd.to_numeric(normalized, errors='coerce').astype(float)
+
+    failed = int((parsed.isna() & (text != '')).sum())
+    return parsed, failed
+
+
+def fillna_zero(df):
+    """
+    df.fillna(0, inplace=True) that leaves categorical columns alone (0 is not one of their categories).
+    """
+    df.fillna({col: 0 for col in df.columns if not isinstance(df[col].dtype, pd.CategoricalDtype)}, inplace=True)
+    return df
+
+
+def build_shared_categories(frames):
+    """
+    One CategoricalDtype per domain from maps.compact_category_domains, built from the values of all frames
+    plus the sentinel markers, so the same value gets the same code in every frame.
+
+    :param frames: DataFrames (None entries are skipped)
+    :return: dict: domain -> CategoricalDtype
+    """
+    categories = {}
+    for domain, columns in compact_category_domains.items():
+        values = set(compact_category_sentinels.get(domain, []))
+        for df in frames:
+            if df is None:
+                continue
+            for col in columns:
+                if col in df.columns:
+                    values.update(df[col].dropna().unique())
+        categories[domain] = pd.CategoricalDtype(sorted(values, key=str))
+
+    return categories
+
+
+def to_compact(df, categories):
+    """
+    Casts key columns to the shared categoricals and float columns holding only whole numbers
+    below 2**24 to float32. Every single value stays exact, but a sum of float32 values above 2**24
+    is rounded - frames have to go through upcast_floats before they are aggregated.
+
+    :param categories: result of build_shared_categories, None = return df unchanged
+    """
+    if df is None or categories is None:
+        return df
+
+    df = df.copy()
+    for domain, columns in compact_category_domains.items():
+        for col in columns:
+            if col in df.columns and df[col].dtype != categories[domain]:
+                df[col] = df[col].astype(categories[domain])
+
+    for col in df.select_dtypes(include='float64').columns:
+        values = df[col].dropna()
+        if ((values % 1 == 0) & (values.abs() < 2 ** 24)).all():
+            df[col] = df[col].astype('float32')
+
+    return df
+
+
+def upcast_floats(df):
+    """
+    float32 columns (see to_compact) back to float64, so sums are accumulated exactly as in the default mode.
+    Returns df itself if it has no float32 columns.
+    """
+    float32_columns = df.select_dtypes(include='float32').columns
+    if float32_columns.empty:
+        return df
+
+    return df.astype({col: 'float64' for col in float32_columns})
+
+
 def generate_zsdkap_filename():
     today_str = datetime.today().strftime("%Y%m%d")
     filename = f"zsdkap_{today_str}_REP_LU_PPS001A"
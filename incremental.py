@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from log_utils import setup_logger
+
+log = setup_logger("INCREMENTAL", "incremental.log")
+
+# Podbić przy każdej zmianie logiki calculate_order_level_KPI / calculate_to_be_produced - stary stan jest wtedy pomijany
+STATE_VERSION = 2
+
+
+def mat_fingerprints(df: Optional[pd.DataFrame]) -> pd.Series:
+    """
+    One uint64 per mat_number, hashed from all columns of the material's rows in their order
+    (the 'first' aggregations of the line merges depend on the row order too).
+    """
+    if df is None or df.empty:
+        return pd.Series(dtype='uint64')
+
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    mats = df['mat_number'].astype(str).to_numpy()
+
+    order = np.argsort(mats, kind='stable')
+    sorted_mats = mats[order]
+    starts = np.flatnonzero(np.r_[True, sorted_mats[1:] != sorted_mats[:-1]])
+    positions = np.arange(len(mats)) - np.repeat(starts, np.diff(np.r_[starts, len(mats)]))
+
+    # Pozycja wiersza w obrębie materiału wmieszana w hash, suma modulo 2**64 per materiał
+    mixed = pd.util.hash_array(row_hashes[order] ^ positions.astype(np.uint64))
+    return pd.Series(np.add.reduceat(mixed, starts), index=sorted_mats[starts])
+
+
+def only_mats(df: Optional[pd.DataFrame], mats) -> Optional[pd.DataFrame]:
+    if df is None:
+        return None
+    return df[df['mat_number'].astype(str).isin(mats)]
+
+
+class LineState:
+    """
+    Inputs and result of one line from the previous run: per material a fingerprint of its ZSDKAP rows
+    (with the horizon columns, so a date moving into a horizon counts as a change), ZSBE rows and
+    MB5TD / MB52 rows, plus the line's detail frame with to_be_produced_* already calculated.
+
+    Every merge of calculate_order_level_KPI is keyed on mat_number, so a material's detail rows only
+    depend on that material's input rows - unchanged materials are taken over from the previous run,
+    changed / new / removed ones are recalculated and the KPIs summed again.
+    """
+
+    def __init__(self, state_dir: str, department: str, line: str, settings: Dict[str, Any]):
+        self.path = Path(state_dir) / f"{re.sub(r'[^0-9A-Za-z_-]', '_', f'{department}_{line}')}.pkl"
+        self.line = line
+        # Inna konfiguracja linii / wersja pandas -> poprzedni stan nie jest porównywalny
+        self.settings = {**settings, 'version': STATE_VERSION, 'pandas': pd.__version__}
+        self.fingerprints: Optional[pd.Series] = None
+        self.previous: Optional[Dict[str, Any]] = None
+
+    def _load(self) -> Optional[Dict[str, Any]]:
+        if not self.path.exists():
+            return None
+        try:
+            state = pd.read_pickle(self.path)
+        except Exception as e:
+            log.warning("Stan linii %s nieczytelny (%s) - pełne przeliczenie", self.line, e)
+            return None
+        if state.get('settings') != self.settings:
+            log.info("Stan linii %s z inną konfiguracją - pełne przeliczenie", self.line)
+            return None
+        return state
+
+    def changed_mats(self, frames: Dict[str, Optional[pd.DataFrame]]) -> set:
+        """
+        Materials of the line (ZSDKAP + ZSBE rows) whose inputs differ from the previous run, plus materials
+        that dropped out of the line. All materials if there is no usable previous state.
+
+        :param frames: zsdkap / zsbe rows of the line, mb5t / mb52 source frames (filtered to the line's materials here)
+        """
+        line_mats = set()
+        for name in ('zsdkap', 'zsbe'):
+            if frames.get(name) is not None:
+                line_mats.update(frames[name]['mat_number'].dropna().astype(str).unique())
+
+        mats_index = pd.Index(sorted(line_mats), dtype=object)
+        # Brak wierszy materiału w danym źródle -> 0 (reindex z fill_value zostawia uint64)
+        fingerprints = pd.DataFrame({
+            name: mat_fingerprints(only_mats(df, line_mats)).reindex(mats_index, fill_value=0).to_numpy(dtype='uint64')
+            for name, df in frames.items()
+        }, index=mats_index)
+        self.fingerprints = pd.Series(pd.util.hash_pandas_object(fingerprints, index=False).to_numpy(),
+                                      index=fingerprints.index)
+
+        self.previous = self._load()
+        if self.previous is None:
+            return set(self.fingerprints.index)
+
+        previous = self.previous['fingerprints']
+        common = self.fingerprints.index.intersection(previous.index)
+        changed = set(common[self.fingerprints[common].to_numpy() != previous[common].to_numpy()])
+        changed |= set(self.fingerprints.index.difference(previous.index))
+        changed |= set(previous.index.difference(self.fingerprints.index))
+        return changed
+
+    def update(self, recalculated: Optional[pd.DataFrame], changed: set) -> pd.DataFrame:
+        """
+        Detail frame of the whole line: recalculated rows of the changed materials + previous rows of the others,
+        in the order of a full run. The new state is saved.
+        """
+        frames = []
+        if self.previous is not None:
+            detail = self.previous['detail']
+            frames.append(detail[~detail['mat_number'].astype(str).isin(changed)])
+        if recalculated is not None:
+            frames.append(recalculated)
+
+        merged = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0].reset_index(drop=True)
+
+        # Kolejność jak przy pełnym przeliczeniu: najpierw zapas ogólny, potem zapas specjalny, każdy wg materiału
+        merged = merged.iloc[np.argsort(merged['mat_number'].astype(str).to_numpy(), kind='stable')]
+        special = (merged['special_stock_indicator'] != 'general_stock').to_numpy()
+        merged = merged.iloc[np.argsort(special, kind='stable')].reset_index(drop=True)
+
+        self._save(merged)
+        return merged
+
+    def _save(self, detail: pd.DataFrame) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        pd.to_pickle({'settings': self.settings, 'fingerprints': self.fingerprints, 'detail': detail}, tmp_file)
+        os.replace(tmp_file, self.path)
@@ -0,0 +1,57 @@
+import numpy as np
+
+
+def calculate_to_be_produced(merged, horizons):
+    """
+    Adds to_be_produced_all, to_be_produced_gr_c and to_be_produced_gr_c_{h}_days columns
+    using array operations instead of a row-wise apply per column.
+
+    :param merged: DataFrame with stock_quantity, transit_quantity, safety_stock, orders_quantity
+                   and orders_quantity_{h}_days columns
+    :param horizons: list of horizons (working days)
+    """
+    stock_quantity = (merged['stock_quantity'] + merged['transit_quantity']).to_numpy(dtype=float)
+    safety_stock = merged['safety_stock'].to_numpy(dtype=float)
+    orders_quantity = merged['orders_quantity'].to_numpy(dtype=float)
+
+    # ALL: stock has to cover orders + safety stock; nothing to produce if a positive safety stock is kept
+    missing_all = orders_quantity + safety_stock - stock_quantity
+    safety_stock_kept = (stock_quantity - orders_quantity >= safety_stock) & (safety_stock > 0)
+    merged['to_be_produced_all'] = np.where(~safety_stock_kept & (missing_all > 0), missing_all, 0)
+
+    # GR C: one broadcast over the orders matrix (rows x [total, *horizons])
+    orders_columns = ['orders_quantity'] + [f'orders_quantity_{h}_days' for h in horizons]
+    orders_matrix = merged[orders_columns].to_numpy(dtype=float)
+    stock_matrix = stock_quantity[:, np.newaxis]
+    to_be_produced_gr_c = np.where(stock_matrix < orders_matrix, orders_matrix - stock_matrix, 0)
+
+    merged['to_be_produced_gr_c'] = to_be_produced_gr_c[:, 0]
+    for i, h in enumerate(horizons, start=1):
+        merged[f'to_be_produced_gr_c_{h}_days'] = to_be_produced_gr_c[:, i]
+
+    return merged
+
+
+def build_horizon_orders_matrix(dispatch_dates, orders_quantity, cutoffs):
+    """
+    Bins every order row once against the sorted horizon cutoffs and returns a (rows x horizons) matrix
+    with the row's quantity where dispatch_date <= cutoff, NaN otherwise (also for missing dispatch dates).
+
+    :param dispatch_dates: array-like of datetimes
+    :param orders_quantity: array-like of quantities
+    :param cutoffs: list of cutoff dates - one per horizon, in horizons order
+    """
+    dispatch_dates = np.asarray(dispatch_dates, dtype='datetime64[ns]')
+    orders_quantity = np.asarray(orders_quantity, dtype=float)
+    cutoffs = np.asarray(cutoffs, dtype='datetime64[ns]')
+
+    cutoffs_order = np.argsort(cutoffs, kind='stable')
+    cutoffs_rank = np.empty_like(cutoffs_order)
+    cutoffs_rank[cutoffs_order] = np.arange(len(cutoffs_order))
+
+    # index of the first (sorted) cutoff the row fits in
+    first_bucket = np.searchsorted(cutoffs[cutoffs_order], dispatch_dates, side='left')
+    first_bucket[np.isnat(dispatch_dates)] = len(cutoffs)
+
+    in_horizon = first_bucket[:, np.newaxis] <= cutoffs_rank[np.newaxis, :]
+    return np.where(in_horizon, orders_quantity[:, np.newaxis], np.nan)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import argparse
+import sqlite3
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Any
+
+import pandas as pd
+from openpyxl import load_workbook
+
+from cache_config import KPI_STORE_PATH
+from helper_functions import append_rows_to_excel
+from log_utils import setup_logger
+
+log = setup_logger("KPI_STORE", "kpi_store.log")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kpi_history (
+    run_id TEXT NOT NULL,
+    run_date TEXT NOT NULL,
+    department TEXT NOT NULL,
+    sheet TEXT NOT NULL,
+    line TEXT NOT NULL,
+    kpi_name TEXT NOT NULL,
+    value REAL,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_kpi_history_line ON kpi_history (line, kpi_name, run_date);
+CREATE INDEX IF NOT EXISTS ix_kpi_history_sheet ON kpi_history (sheet, recorded_at);
+"""
+
+# Column of the KPI sheet holding the line name (not a KPI value)
+LINE_KEY = "LINE"
+
+
+class KpiStore:
+    """
+    Append-only history of KPI results, one row per run / department / line / KPI name.
+
+    Rows are only inserted, never updated - a re-run on the same day is stored as a new run_id.
+    KPIs_source_data.xlsx is a view of this table (see rebuild_excel).
+    """
+
+    def __init__(self, path: Path = KPI_STORE_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), timeout=30)
+        self.conn.executescript(SCHEMA)
+
+    def append(
+        self,
+        department: str,
+        sheet: str,
+        kpis_results: List[Dict[str, Any]],
+        run_date: Optional[str] = None,
+    ) -> str:
+        """
+        Stores KPI dicts of one run (as produced by kpis_loop, with the LINE key). Returns the run_id.
+        """
+        recorded_at = time.time()
+        run_date = run_date or datetime.today().strftime('%Y-%m-%d')
+        run_id = f"{department}|{datetime.fromtimestamp(recorded_at):%Y%m%d%H%M%S%f}"
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO kpi_history (run_id, run_date, department, sheet, line, kpi_name, value, recorded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (run_id, run_date, department, sheet, str(kpis[LINE_KEY]), kpi_name, value, recorded_at)
+                    for kpis in kpis_results
+                    for kpi_name, value in kpis.items()
+                    if kpi_name != LINE_KEY
+                ),
+            )
+        log.info("KPI run %s: %d lines stored", run_id, len(kpis_results))
+        return run_id
+
+    def trend(
+        self,
+        line: str,
+        kpi_name: str,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+    ) -> pd.DataFrame:
+        """
+        KPI values of one line per day (the last run of the day), e.g. trend("M200", "ORDERS LEVEL (GR C - 5)").
+        """
+        query = (
+            "SELECT run_date, value FROM kpi_history h "
+            "WHERE line = ? AND kpi_name = ? AND recorded_at = ("
+            "    SELECT MAX(recorded_at) FROM kpi_history "
+            "    WHERE line = h.line AND kpi_name = h.kpi_name AND run_date = h.run_date)"
+        )
+        params: List[Any] = [line, kpi_name]
+        if since:
+            query += " AND run_date >= ?"
+            params.append(since)
+        if until:
+            query += " AND run_date <= ?"
+            params.append(until)
+
+        return pd.read_sql_query(query + " ORDER BY run_date", self.conn, params=params)
+
+    def history(self, sheet: str) -> pd.DataFrame:
+        """
+        One row per run and line in the order they were recorded: run_date, LINE and one column per KPI name.
+        """
+        long_df = pd.read_sql_query(
+            "SELECT run_id, run_date, line, kpi_name, value, recorded_at FROM kpi_history WHERE sheet = ? "
+            "ORDER BY recorded_at, rowid",
+            self.conn,
+            params=[sheet],
+        )
+        if long_df.empty:
+            return pd.DataFrame(columns=['run_date', LINE_KEY])
+
+        # Kolejność wierszy jak w arkuszu: wg pierwszego wystąpienia (run, linia)
+        order = long_df[['run_id', 'line']].drop_duplicates().reset_index(drop=True).reset_index()
+        wide_df = long_df.pivot_table(index=['run_id', 'run_date', 'line'], columns='kpi_name', values='value',
+                                      aggfunc='last', sort=False).reset_index()
+        wide_df = wide_df.merge(order, on=['run_id', 'line']).sort_values('index')
+
+        return wide_df.drop(columns=['index', 'run_id']).rename(columns={'line': LINE_KEY}).reset_index(drop=True)
+
+    def has_excel_import(self, sheet: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM kpi_history WHERE sheet = ? AND run_id LIKE 'excel|%' LIMIT 1", (sheet,)
+        ).fetchone()
+        return row is not None
+
+    def import_excel(self, status_file: str, sheet_name: str, department: str = "") -> int:
+        """
+        One-off seed of the store with the records already in the KPI sheet (each sheet row becomes its own run).
+        A sheet imported before is skipped, sheet rows equal to a run already in the store (same date, line and
+        KPI values - runs written to the sheet since the store exists) are not imported again.
+        Returns the number of imported rows.
+        """
+        if self.has_excel_import(sheet_name):
+            log.info("Sheet [%s] already imported - skipped", sheet_name)
+            return 0
+
+        # Runy zapisane już przez append - ich wiersze w arkuszu są pomijane (po jednym wierszu na run i linię)
+        stored = Counter(_record_key(record) for record in self.history(sheet_name).to_dict('records'))
+
+        imported = 0
+        skipped = 0
+        with self.conn:
+            for row_num, record in _read_sheet_records(status_file, sheet_name):
+                run_date = record['run_date']
+                key = _record_key(record)
+                if stored[key] > 0:
+                    stored[key] -= 1
+                    skipped += 1
+                    continue
+
+                run_id = f"excel|{sheet_name}|{row_num}"
+                self.conn.executemany(
+                    "INSERT INTO kpi_history (run_id, run_date, department, sheet, line, kpi_name, value, recorded_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        (run_id, run_date, department, sheet_name, record[LINE_KEY], kpi_name, value, float(row_num))
+                        for kpi_name, value in record.items()
+                        if kpi_name not in ('run_date', LINE_KEY)
+                    ),
+                )
+                imported += 1
+
+        log.info("Imported %d rows from %s [%s] (%d already in the store)", imported, status_file, sheet_name, skipped)
+        return imported
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def _to_number(value: Any) -> Optional[float]:
+    if value in (None, ""):
+        return None
+    number = pd.to_numeric(str(value).replace(',', '.'), errors='coerce')
+    return None if pd.isna(number) else float(number)
+
+
+def _read_sheet_records(status_file: str, sheet_name: str):
+    """
+    (row number, record) per filled row of the KPI sheet - record: run_date, LINE and numeric KPI values.
+    """
+    ws = load_workbook(status_file, read_only=True)[sheet_name]
+    rows = ws.iter_rows(values_only=True)
+    headers = next(rows)
+
+    for row_num, values in enumerate(rows, start=2):
+        if values[0] in (None, ""):
+            continue
+        record = {'run_date': str(values[0])[:10], LINE_KEY: None}
+        for kpi_name, value in zip(headers[1:], values[1:]):
+            if kpi_name == LINE_KEY:
+                record[LINE_KEY] = str(value)
+            elif kpi_name is not None:
+                record[str(kpi_name)] = _to_number(value)
+        yield row_num, record
+
+
+def _record_key(record: Dict[str, Any]) -> tuple:
+    values = frozenset((name, value) for name, value in record.items()
+                       if name not in ('run_date', LINE_KEY) and value is not None and not pd.isna(value))
+    return record['run_date'], str(record[LINE_KEY]), values
+
+
+def _format_value(value: Any) -> Any:
+    # Arkusz zawsze dostawał str(int) z calculate_order_level_KPI
+    if value is None or pd.isna(value):
+        return ""
+    return int(value) if float(value).is_integer() else value
+
+
+def rebuild_excel(status_file: str, sheet_name: str, error_path: str, store: Optional[KpiStore] = None) -> None:
+    """
+    Regenerates the records of the KPI sheet from the store (headers and formatting of the sheet stay).
+
+    The sheet is only replaced if the store holds all of its records: the sheet was imported (import_excel)
+    or it has as many records as the store. Otherwise it is imported first; if the store still has fewer
+    records than the sheet, nothing is rebuilt.
+    """
+    own_store = store is None
+    store = store or KpiStore()
+    try:
+        history = store.history(sheet_name)
+        sheet_records = sum(1 for _ in _read_sheet_records(status_file, sheet_name))
+
+        if not store.has_excel_import(sheet_name) and sheet_records != len(history):
+            print(f"KPI store has {len(history)} records for sheet '{sheet_name}', the sheet {sheet_records} - "
+                  f"importing the sheet into the store first")
+            store.import_excel(status_file, sheet_name)
+            history = store.history(sheet_name)
+
+        if history.empty:
+            print(f"KPI store has no records for sheet '{sheet_name}' - nothing to rebuild")
+            return
+        if len(history) < sheet_records:
+            print(f"KPI store has {len(history)} records for sheet '{sheet_name}', the sheet {sheet_records} - "
+                  f"rebuilding would drop records, sheet left unchanged")
+            return
+
+        data_dicts = [
+            {kpi_name: _format_value(value) if kpi_name != LINE_KEY else value for kpi_name, value in record.items()}
+            for record in history.drop(columns=['run_date']).to_dict('records')
+        ]
+        append_rows_to_excel(status_file, data_dicts, error_path, sheet_name,
+                             dates=history['run_date'].tolist(), replace=True)
+    finally:
+        if own_store:
+            store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KPI history")
+    parser.add_argument('line')
+    parser.add_argument('kpi_name', help="e.g. 'ORDERS LEVEL (GR C - 5)'")
+    parser.add_argument('--since', help="YYYY-MM-DD")
+    parser.add_argument('--until', help="YYYY-MM-DD")
+    args = parser.parse_args()
+
+    kpi_store = KpiStore()
+    print(kpi_store.trend(args.line, args.kpi_name, args.since, args.until).to_string(index=False))
+    kpi_store.close()
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+
+def _as_tuple(value):
+    return (value,) if isinstance(value, str) else tuple(value)
+
+
+def build_prefix_trie(prefixes_by_line):
+    """
+    :param prefixes_by_line: dict: line -> iterable of description prefixes
+    :return: nested dict (one level per character), key None holds the lines whose prefix ends in that node
+    """
+    trie = {}
+    for line, prefixes in prefixes_by_line.items():
+        for prefix in prefixes:
+            node = trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(None, set()).add(line)
+
+    return trie
+
+
+def match_prefixes(trie, text):
+    """
+    Lines having at least one prefix that text starts with (same as str.startswith(prefixes)).
+    """
+    lines = set(trie.get(None, ()))
+    node = trie
+    for char in text:
+        node = node.get(char)
+        if node is None:
+            break
+        lines.update(node.get(None, ()))
+
+    return lines
+
+
+def build_line_index(df, lines, mrp_controllers, product_names):
+    """
+    Assigns every row of df to all lines it belongs to: MRP controller of the line and description starting
+    with one of the line's product names. Lines may overlap (e.g. M200/M300 share L3H, L82, L11), a row then
+    belongs to each of them.
+
+    Matching runs once per unique (mrp_controller, mat_description) pair through a prefix trie,
+    not once per line over all rows.
+
+    :param df: DataFrame with mrp_controller and mat_description columns
+    :param lines: line names, in the same order as mrp_controllers and product_names
+    :return: dict: line -> ascending numpy array of row positions (for df.iloc / df.take)
+    """
+    controllers_by_line = {line: set(_as_tuple(mrp)) for line, mrp in zip(lines, mrp_controllers)}
+    trie = build_prefix_trie({line: _as_tuple(prd_name) for line, prd_name in zip(lines, product_names)})
+
+    pairs = pd.MultiIndex.from_arrays([
+        df['mrp_controller'].astype(object).to_numpy(),
+        df['mat_description'].astype(object).to_numpy(),
+    ])
+    pair_codes, unique_pairs = pd.factorize(pairs)
+
+    pair_codes_by_line = {line: [] for line in controllers_by_line}
+    for code, (mrp, description) in enumerate(unique_pairs):
+        # Brak opisu (NaN/NA) -> wiersz nie należy do żadnej linii
+        if not isinstance(description, str):
+            continue
+        for line in match_prefixes(trie, description):
+            if mrp in controllers_by_line[line]:
+                pair_codes_by_line[line].append(code)
+
+    return {
+        line: np.flatnonzero(np.isin(pair_codes, codes)) if codes else np.empty(0, dtype=np.intp)
+        for line, codes in pair_codes_by_line.items()
+    }
+
+
+def line_rows_mask(line_index, length):
+    """
+    Boolean array, True for rows that belong to at least one line of line_index.
+    """
+    mask = np.zeros(length, dtype=bool)
+    for positions in line_index.values():
+        mask[positions] = True
+
+    return mask
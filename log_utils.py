@@ -1,4 +1,12 @@
+import cProfile
+import contextvars
+import json
 import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
 from logging.handlers import RotatingFileHandler
 import sys
 import os
@@ -62,3 +70,117 @@ def setup_logger(name: str, logfile: str) -> logging.Logger:
     logger.addHandler(ch)
 
     return logger
+
+
+_warned: set = set()
+_warned_lock = threading.Lock()
+
+
+def warn_once(logger: logging.Logger, message: str, *args) -> None:
+    """
+    logger.warning only the first time this message is logged in the process (e.g. a missing optional package).
+    """
+    with _warned_lock:
+        if (logger.name, message) in _warned:
+            return
+        _warned.add((logger.name, message))
+    logger.warning(message, *args)
+
+
+# Tags (department, line, ...) added to every stage logged in the current context
+_stage_tags: contextvars.ContextVar[dict] = contextvars.ContextVar("stage_tags", default={})
+
+
+@contextmanager
+def stage_tags(**tags):
+    token = _stage_tags.set({**_stage_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _stage_tags.reset(token)
+
+
+def set_stage_tags(**tags) -> None:
+    """
+    Sets tags for the rest of the current context (e.g. in a worker process initializer).
+    """
+    _stage_tags.set({**_stage_tags.get(), **tags})
+
+
+# Running stages - with tracemalloc on, every peak reset first passes the peak so far to all of them
+_running_stages: list = []
+_running_stages_lock = threading.Lock()
+
+
+class StageTimer:
+    """
+    Times one stage of a run and logs it as a single JSON line, e.g.
+    {"stage": "vbap_rfc", "department": "wmo", "rows": 1234, "seconds": 2.41, "status": "ok"}
+
+    Usable as a context manager or started/stopped explicitly (stop() logs only once).
+    Extra fields (e.g. rows) can be set on .fields or passed to stop(). Tags set with stage_tags()
+    (department, line) are added automatically - threads started through contextvars.copy_context().run
+    keep them.
+
+    With tracemalloc tracing (e.g. benchmarks.run_benchmarks) peak_mb = peak of traced memory of the process
+    while the stage was running (stages running at the same time see each other's allocations).
+    """
+
+    def __init__(self, logger: logging.Logger, stage: str, **tags):
+        self.logger = logger
+        tags = {**_stage_tags.get(), **tags}
+        self.fields = {"stage": stage, **{k: v for k, v in tags.items() if v is not None}}
+        self.start = time.perf_counter()
+        self.stopped = False
+        self.peak = 0
+        if tracemalloc.is_tracing():
+            with _running_stages_lock:
+                self._pass_peak()
+                tracemalloc.reset_peak()
+                _running_stages.append(self)
+
+    @staticmethod
+    def _pass_peak() -> int:
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage in _running_stages:
+            stage.peak = max(stage.peak, peak)
+        return peak
+
+    def stop(self, status: str = "ok", **fields) -> float:
+        seconds = time.perf_counter() - self.start
+        if not self.stopped:
+            self.stopped = True
+            self.fields.update(fields)
+            self.fields.update(seconds=round(seconds, 4), status=status)
+            if self in _running_stages:
+                with _running_stages_lock:
+                    self._pass_peak()
+                    _running_stages.remove(self)
+                self.fields["peak_mb"] = round(self.peak / 2 ** 20, 1)
+            self.logger.info(json.dumps(self.fields, ensure_ascii=False, default=str))
+        return seconds
+
+    def __enter__(self) -> "StageTimer":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop(status="ok" if exc_type is None else "error")
+
+
+def stage_timer(logger: logging.Logger, stage: str, **tags) -> StageTimer:
+    return StageTimer(logger, stage, **tags)
+
+
+def run_profiled(stats_file: str, func, *args, **kwargs):
+    """
+    Runs func under cProfile and dumps the stats next to the logs (open with pstats / snakeviz).
+    Only the calling thread is profiled - reader threads and line worker processes are not.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        stats_path = _resolve_logfile_path(stats_file)
+        profiler.dump_stats(str(stats_path))
+        print(f"Profil zapisany: {stats_path}")
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats("cumulative").print_stats(25)
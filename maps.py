@@ -154,4 +154,22 @@ production_site_map = {
     'MQ4': '0301',
     'MNW': '0301',
     'MRR': '0301'
-}
\ No newline at end of file
+}
+# Compact schema (--compact): key columns stored as categoricals with one dictionary per domain,
+# shared by ZSDKAP, ZSBE, ZKBP1, MB5TD and MB52 so merges compare integer codes
+compact_category_domains = {
+    'mat_number': ['mat_number'],
+    'customer_order_number': ['customer_order_number'],
+    'customer_order_position': ['customer_order_position'],
+    'plant': ['plant', 'delivery_plant', 'production_site'],
+    'mrp_controller': ['mrp_controller'],
+    'special_stock_indicator': ['special_stock_indicator'],
+    'storage_location': ['storage_location'],
+}
+
+# Markers assigned inside calculate_order_level_KPI - must exist as categories upfront
+compact_category_sentinels = {
+    'customer_order_number': ['general_stock_position', 'grouped_orders'],
+    'customer_order_position': ['general_stock_position', 'grouped_orders'],
+    'special_stock_indicator': ['general_stock', ''],
+}
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+from openpyxl import Workbook
+
+from cache_config import CACHE_DIR
+from log_utils import setup_logger, warn_once
+from shared_frames import HAS_PYARROW, dump_frame, load_frame
+
+log = setup_logger("OUTPUT_SINKS", "output_sinks.log")
+
+# xlsx     - one workbook per line (as before)
+# csv      - one CSV per line (; separator, opens directly in Polish Excel)
+# parquet  - one Parquet file per line
+# workbook - one workbook per run, a sheet per line, streamed row by row (write-only mode, constant memory)
+# none     - detail output is not written
+DETAIL_OUTPUT_MODES = ("xlsx", "csv", "parquet", "workbook", "none")
+
+
+class DetailSink:
+    """
+    Destination of the per-line detail frames of calculate_order_level_KPI.
+    """
+
+    def write(self, df: pd.DataFrame, name: str, sheet_name: Optional[str] = None) -> None:
+        pass
+
+    def for_workers(self) -> "DetailSink":
+        """
+        Sink used inside line worker processes (must be picklable).
+        """
+        return self
+
+    def take_spooled(self, sheet_name: str) -> None:
+        """
+        Called in the main process, in line order, once a worker finished the line.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class XlsxDetailSink(DetailSink):
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+    def write(self, df: pd.DataFrame, name: str, sheet_name: Optional[str] = None) -> None:
+        df.to_excel(f"{self.output_dir}/{name}.xlsx")
+
+
+class CsvDetailSink(DetailSink):
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+    def write(self, df: pd.DataFrame, name: str, sheet_name: Optional[str] = None) -> None:
+        df.to_csv(f"{self.output_dir}/{name}.csv", sep=";", decimal=",", encoding="utf-8-sig")
+
+
+class ParquetDetailSink(DetailSink):
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+    def write(self, df: pd.DataFrame, name: str, sheet_name: Optional[str] = None) -> None:
+        df.to_parquet(f"{self.output_dir}/{name}.parquet")
+
+
+class SpoolDetailSink(DetailSink):
+    """
+    Worker side of WorkbookDetailSink - frames are parked in a local spool directory.
+    """
+
+    def __init__(self, spool_dir: str):
+        self.spool_dir = spool_dir
+
+    def write(self, df: pd.DataFrame, name: str, sheet_name: Optional[str] = None) -> None:
+        dump_frame(df, Path(self.spool_dir) / f"{sheet_name or name}.arrow")
+
+
+class WorkbookDetailSink(DetailSink):
+    """
+    All lines of a run in one workbook, a sheet per line. openpyxl write-only mode streams rows to disk,
+    so memory does not grow with the number of lines and cell objects are never built for the whole sheet.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+        self.spool_dir: Optional[str] = None
+
+    def write(self, df: pd.DataFrame, name: str, sheet_name: Optional[str] = None) -> None:
+        # Excel: max 31 znaków w nazwie arkusza
+        ws = self.workbook.create_sheet(title=(sheet_name or name)[:31])
+        ws.append([None, *map(str, df.columns)])
+
+        # NaN/NA -> pusta komórka (openpyxl zapisałby 'nan')
+        values = df.astype(object).where(df.notna(), None)
+        for row in values.itertuples(index=True, name=None):
+            ws.append(row)
+
+    def for_workers(self) -> DetailSink:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        self.spool_dir = tempfile.mkdtemp(prefix="detail_spool_", dir=CACHE_DIR)
+        return SpoolDetailSink(self.spool_dir)
+
+    def take_spooled(self, sheet_name: str) -> None:
+        spool_file = Path(self.spool_dir) / f"{sheet_name}.arrow"
+        self.write(load_frame(spool_file), sheet_name, sheet_name)
+        os.remove(spool_file)
+
+    def close(self) -> None:
+        # Zapis do pliku tymczasowego i podmiana - nie zostaje niedokończony skoroszyt ani plik tymczasowy
+        try:
+            if self.workbook.worksheets:
+                tmp_file = f"{self.path}.{os.getpid()}.tmp.xlsx"
+                try:
+                    self.workbook.save(tmp_file)
+                    os.replace(tmp_file, self.path)
+                finally:
+                    if os.path.exists(tmp_file):
+                        os.remove(tmp_file)
+                log.info("Detail workbook saved: %s (%d sheets)", self.path, len(self.workbook.worksheets))
+        finally:
+            if self.spool_dir:
+                shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+
+def make_detail_sink(mode: str, output_dir: str, run_name: str) -> DetailSink:
+    """
+    :param mode: one of DETAIL_OUTPUT_MODES
+    :param run_name: file name (without extension) of the per-run workbook
+    """
+    if mode == "xlsx":
+        return XlsxDetailSink(output_dir)
+    if mode == "csv":
+        return CsvDetailSink(output_dir)
+    if mode == "parquet":
+        if not HAS_PYARROW:
+            warn_once(log, "Brak pyarrow - detail output zapisywany jako CSV zamiast Parquet (pip install -r requirements.txt)")
+            return CsvDetailSink(output_dir)
+        return ParquetDetailSink(output_dir)
+    if mode == "workbook":
+        return WorkbookDetailSink(f"{output_dir}/{run_name}.xlsx")
+    if mode == "none":
+        return DetailSink()
+
+    raise ValueError(f"Unknown detail output mode: {mode!r} (available: {', '.join(DETAIL_OUTPUT_MODES)})")
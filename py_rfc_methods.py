@@ -1,53 +1,166 @@
 import pandas as pd
-from sap_conn import get_conn
-from sap_rtab import rfc_read_table
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from sap_conn import get_conn, get_conn_pool
+from sap_rtab import rfc_read_table_df, build_key_where
+from rfc_cache import RfcLookupCache
 
 from helper_functions import chunks
 
 import time
 
 
-def get_delivery_plants_df(sap_system, orders_list, chunk_size=1000, printing_frequency=2):
-    vbeln_chunks = list(chunks(orders_list, chunk_size))
-    vbap = []
-
-    with get_conn(sap_system) as conn:
-
-        for chunk_num, vbeln_chunk in enumerate(vbeln_chunks, start=1):
-            is_printing = chunk_num % printing_frequency == 0
-            chunk_start = time.perf_counter()
-
-            vbeln_filter = " OR ".join(
-                [f"VBELN = '{m}'" for m in vbeln_chunk]
-            )
-
-            vbap_chunk_data = rfc_read_table(
-                conn=conn,
-                table="VBAP",
-                fields=[
-                    "VBELN",  # zlecenie klienta
-                    "POSNR",  # pozycja
-                    "WERKS",  # zakład dostarczający
-                    "SOBKZ",  # special stock indicator - "E" for special customer requirements
-                ],
-                where=f"""
-                    {vbeln_filter}
-                """,
-                # rowcount=1500
-            )
-
-            vbap.extend(vbap_chunk_data)
-
-            if is_printing:
-                print(
-                    f"\nVBELN chunk {chunk_num}/{len(vbeln_chunks)} "
-                    f"| docs={len(vbeln_chunk)}"
-                    f"\n Chunk time: {time.perf_counter() - chunk_start:.2f} s"
-                )
-
-        vbap_df = pd.DataFrame(
-            vbap,
-            columns=["VBELN", "POSNR", "WERKS", "SOBKZ"]
+def _read_chunk(conn, table, fields, key_field, key_chunk, chunk_num, chunks_count, printing_frequency, page_size=0):
+    is_printing = chunk_num % printing_frequency == 0
+    chunk_start = time.perf_counter()
+    where = build_key_where(key_field, key_chunk)
+
+    pages = []
+    rows_read = 0
+    while True:
+        page_df = rfc_read_table_df(
+            conn=conn,
+            table=table,
+            fields=fields,
+            where=where,
+            rowcount=page_size,
+            rowskips=rows_read if page_size else 0,
+        )
+        pages.append(page_df)
+        rows_read += len(page_df)
+
+        # page_size=0 -> no paging, SAP returns everything at once
+        if not page_size or len(page_df) < page_size:
+            break
+
+    chunk_df = pages[0] if len(pages) == 1 else pd.concat(pages, ignore_index=True)
+
+    if is_printing:
+        print(
+            f"\n{key_field} chunk {chunk_num}/{chunks_count} "
+            f"| docs={len(key_chunk)}"
+            f"\nChunk time: {time.perf_counter() - chunk_start:.2f} s"
+        )
+
+    return chunk_df
+
+
+def _fetch_chunks(sap_system, table, fields, key_field, key_chunks, printing_frequency, max_workers=1, page_size=0):
+    """
+    Yields RFC_READ_TABLE results for every chunk of keys, in the order of key_chunks.
+
+    With max_workers > 1 chunks are fetched concurrently, each worker using its own connection
+    from a bounded pool (one pyrfc connection must not be used by two threads at once). At most
+    2 * workers chunks are in flight, so results not yet taken by the consumer do not pile up.
+    """
+    chunks_count = len(key_chunks)
+
+    if max_workers <= 1 or chunks_count <= 1:
+        with get_conn(sap_system) as conn:
+            for chunk_num, key_chunk in enumerate(key_chunks, start=1):
+                yield _read_chunk(conn, table, fields, key_field, key_chunk, chunk_num, chunks_count,
+                                  printing_frequency, page_size)
+        return
+
+    workers = min(max_workers, chunks_count)
+
+    with get_conn_pool(sap_system, workers) as pool, ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def read_pooled_chunk(chunk_num, key_chunk):
+            conn = pool.get()
+            try:
+                return _read_chunk(conn, table, fields, key_field, key_chunk, chunk_num, chunks_count,
+                                   printing_frequency, page_size)
+            finally:
+                pool.put(conn)
+
+        # Okno zleceń: następny chunk jest zlecany dopiero po odebraniu najstarszego, kolejność jak key_chunks
+        in_flight = deque()
+        for chunk_num, key_chunk in enumerate(key_chunks, start=1):
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(read_pooled_chunk, chunk_num, key_chunk))
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def iter_keyed_lookup(sap_system, table, key_field, fields, keys, chunk_size=1000, printing_frequency=2,
+                      max_workers=1, page_size=0, use_cache=False, force_refresh=False, dtype="string"):
+    """
+    Generic SAP table lookup by one key field - yields a DataFrame (columns=fields) per chunk of keys
+    as soon as it arrives. Only a window of chunks is fetched ahead (see _fetch_chunks), so a consumer
+    that processes the chunks one by one holds chunk_size * window rows, not the total result.
+
+    :param table: SAP table, e.g. "VBAP"
+    :param key_field: field the keys are matched on, e.g. "VBELN"
+    :param fields: fields to read
+    :param keys: iterable of key values (deduplicated here)
+    :param page_size: ROWCOUNT per RFC call for wide results (ROWSKIPS is advanced automatically), 0 = no paging
+    :param use_cache: answer fresh keys from the local RFC cache, only missing/stale keys go to SAP
+    :param dtype: dtype for all returned columns
+    """
+    keys = list(dict.fromkeys(keys))  # the same order is listed once per position
+    cache = RfcLookupCache() if use_cache else None
+
+    def to_frame(rows):
+        return pd.DataFrame(rows, columns=fields).astype(dtype)
+
+    try:
+        if cache is not None:
+            missing = []
+            for keys_chunk in chunks(keys, chunk_size):
+                cached_rows, missing_chunk = cache.get(table, fields, key_field, keys_chunk, force_refresh)
+                missing.extend(missing_chunk)
+                if cached_rows:
+                    yield to_frame(cached_rows)
+            keys = missing
+
+        key_chunks = list(chunks(keys, chunk_size))
+        for key_chunk, chunk_df in zip(key_chunks, _fetch_chunks(
+            sap_system,
+            table=table,
+            fields=fields,
+            key_field=key_field,
+            key_chunks=key_chunks,
+            printing_frequency=printing_frequency,
+            max_workers=max_workers,
+            page_size=page_size,
+        )):
+            if cache is not None:
+                cache.put(table, fields, key_field, key_chunk, chunk_df.to_dict("records"))
+            yield chunk_df.reindex(columns=fields).astype(dtype)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def keyed_lookup_df(sap_system, table, key_field, fields, keys, **lookup_options):
+    """
+    iter_keyed_lookup collected into a single DataFrame (the whole result in memory).
+    """
+    frames = list(iter_keyed_lookup(sap_system, table, key_field, fields, keys, **lookup_options))
+    if not frames:
+        return pd.DataFrame(columns=fields).astype(lookup_options.get("dtype", "string"))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_delivery_plants_df(sap_system, orders_list, chunk_size=1000, printing_frequency=2, **lookup_options):
+    vbap_df = keyed_lookup_df(
+        sap_system,
+        table="VBAP",
+        key_field="VBELN",
+        fields=[
+            "VBELN",  # zlecenie klienta
+            "POSNR",  # pozycja
+            "WERKS",  # zakład dostarczający
+            "SOBKZ",  # special stock indicator - "E" for special customer requirements
+        ],
+        keys=orders_list,
+        chunk_size=chunk_size,
+        printing_frequency=printing_frequency,
+        **lookup_options
     )
 
     vbap_df.drop_duplicates(subset=["VBELN", "POSNR"], keep="first", inplace=True)
@@ -55,46 +168,20 @@ def get_delivery_plants_df(sap_system, orders_list, chunk_size=1000, printing_fr
     return vbap_df
 
 
-def get_special_stock_indicators(sap_system, orders_list, chunk_size=1000, printing_frequency=2):
-    vbeln_chunks = list(chunks(orders_list, chunk_size))
-    vbbe = []
-
-    with get_conn(sap_system) as conn:
-
-        for chunk_num, vbeln_chunk in enumerate(vbeln_chunks, start=1):
-            is_printing = chunk_num % printing_frequency == 0
-            chunk_start = time.perf_counter()
-
-            vbeln_filter = " OR ".join(
-                [f"VBELN = '{m}'" for m in vbeln_chunk]
-            )
-
-            vbbe_chunk_data = rfc_read_table(
-                conn=conn,
-                table="VBBE",
-                fields=[
-                    "VBELN",  # zlecenie klienta
-                    "POSNR",  # pozycja
-                    "SOBKZ",  # special stock indicator - "E" for special customer requirements
-                ],
-                where=f"""
-                    {vbeln_filter}
-                """,
-                # rowcount=1500
-            )
-
-            vbbe.extend(vbbe_chunk_data)
-
-            if is_printing:
-                print(
-                    f"\nVBELN chunk {chunk_num}/{len(vbeln_chunks)} "
-                    f"| docs={len(vbeln_chunk)}"
-                    f"\n Chunk time: {time.perf_counter() - chunk_start:.2f} s"
-                )
-
-        vbbe_df = pd.DataFrame(
-            vbbe,
-            columns=["VBELN", "POSNR", "SOBKZ"]
+def get_special_stock_indicators(sap_system, orders_list, chunk_size=1000, printing_frequency=2, **lookup_options):
+    vbbe_df = keyed_lookup_df(
+        sap_system,
+        table="VBBE",
+        key_field="VBELN",
+        fields=[
+            "VBELN",  # zlecenie klienta
+            "POSNR",  # pozycja
+            "SOBKZ",  # special stock indicator - "E" for special customer requirements
+        ],
+        keys=orders_list,
+        chunk_size=chunk_size,
+        printing_frequency=printing_frequency,
+        **lookup_options
     )
 
     vbbe_df.drop_duplicates(subset=["VBELN", "POSNR"], keep="first", inplace=True)
@@ -102,47 +189,21 @@ def get_special_stock_indicators(sap_system, orders_list, chunk_size=1000, print
     return vbbe_df
 
 
-def get_purchase_order_sales_orders(sap_system, po_list, chunk_size=1000, printing_frequency=2):
-    ebeln_chunks = list(chunks(po_list, chunk_size))
-    ekkn = []
-
-    with get_conn(sap_system) as conn:
-
-        for chunk_num, ebeln_chunk in enumerate(ebeln_chunks, start=1):
-            is_printing = chunk_num % printing_frequency == 0
-            chunk_start = time.perf_counter()
-
-            ebeln_filter = " OR ".join(
-                [f"EBELN = '{po}'" for po in ebeln_chunk]
-            )
-
-            ekkn_chunk_data = rfc_read_table(
-                conn=conn,
-                table="EKKN",
-                fields=[
-                    "EBELN",  # Purchase Order
-                    "EBELP",  # Purchase Order Item
-                    "VBELN",  # Sales Order
-                    "VBELP",  # Sales Order Item
-                ],
-                where=f"""
-                    {ebeln_filter}
-                """,
-                # rowcount=1500
-            )
-
-            ekkn.extend(ekkn_chunk_data)
-
-            if is_printing:
-                print(
-                    f"\nEBELN chunk {chunk_num}/{len(ebeln_chunks)} "
-                    f"| docs={len(ebeln_chunk)}"
-                    f"\nChunk time: {time.perf_counter() - chunk_start:.2f} s"
-                )
-
-    ekkn_df = pd.DataFrame(
-        ekkn,
-        columns=["EBELN", "EBELP", "VBELN", "VBELP"]
+def get_purchase_order_sales_orders(sap_system, po_list, chunk_size=1000, printing_frequency=2, **lookup_options):
+    ekkn_df = keyed_lookup_df(
+        sap_system,
+        table="EKKN",
+        key_field="EBELN",
+        fields=[
+            "EBELN",  # Purchase Order
+            "EBELP",  # Purchase Order Item
+            "VBELN",  # Sales Order
+            "VBELP",  # Sales Order Item
+        ],
+        keys=po_list,
+        chunk_size=chunk_size,
+        printing_frequency=printing_frequency,
+        **lookup_options
     )
 
     ekkn_df.drop_duplicates(
@@ -151,4 +212,4 @@ def get_purchase_order_sales_orders(sap_system, po_list, chunk_size=1000, printi
         inplace=True
     )
 
-    return ekkn_df
\ No newline at end of file
+    return ekkn_df
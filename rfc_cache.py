@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple, Sequence, Iterable, Optional, Any
+
+from cache_config import RFC_CACHE_PATH, RFC_CACHE_TTL, RFC_CACHE_DEFAULT_TTL
+from helper_functions import chunks
+from log_utils import setup_logger
+
+log = setup_logger("RFC_CACHE", "rfc_cache.log")
+
+# SQLite ma limit zmiennych w jednym zapytaniu
+SQL_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lookup (
+    lookup_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    rows TEXT NOT NULL,
+    PRIMARY KEY (lookup_id, key)
+);
+CREATE TABLE IF NOT EXISTS lookup_stats (
+    run_at REAL NOT NULL,
+    lookup_id TEXT NOT NULL,
+    hits INTEGER NOT NULL,
+    misses INTEGER NOT NULL
+);
+"""
+
+
+class RfcLookupCache:
+    """
+    On-disk cache of rfc_read_table results keyed by table + requested fields + key field + key value.
+
+    Every requested key is stored, also keys SAP returned no rows for, so they are not asked again
+    until their TTL (RFC_CACHE_TTL per table) expires.
+    """
+
+    def __init__(self, path: Path = RFC_CACHE_PATH, ttl: Optional[Dict[str, Any]] = None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = RFC_CACHE_TTL if ttl is None else ttl
+        self.conn = sqlite3.connect(str(self.path), timeout=30)
+        self.conn.executescript(SCHEMA)
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    @staticmethod
+    def lookup_id(table: str, fields: Sequence[str], key_field: str) -> str:
+        return f"{table}|{key_field}|{','.join(fields)}"
+
+    def _ttl_seconds(self, table: str) -> float:
+        return self.ttl.get(table, RFC_CACHE_DEFAULT_TTL).total_seconds()
+
+    def get(
+        self,
+        table: str,
+        fields: Sequence[str],
+        key_field: str,
+        keys: Iterable[str],
+        force_refresh: bool = False,
+    ) -> Tuple[List[Dict[str, str]], List[str]]:
+        """
+        Returns (cached rows of fresh keys, keys that are missing or stale and have to be read from SAP).
+        """
+        keys = list(dict.fromkeys(keys))
+        lookup_id = self.lookup_id(table, fields, key_field)
+        rows: List[Dict[str, str]] = []
+        fresh = set()
+
+        if not force_refresh:
+            oldest_fresh = time.time() - self._ttl_seconds(table)
+            for keys_batch in chunks(keys, SQL_BATCH):
+                cursor = self.conn.execute(
+                    f"SELECT key, rows FROM lookup WHERE lookup_id = ? AND fetched_at >= ? "
+                    f"AND key IN ({','.join('?' * len(keys_batch))})",
+                    [lookup_id, oldest_fresh, *keys_batch],
+                )
+                for key, key_rows in cursor:
+                    fresh.add(key)
+                    rows.extend(json.loads(key_rows))
+
+        missing = [k for k in keys if k not in fresh]
+
+        table_stats = self.stats.setdefault(lookup_id, {"hits": 0, "misses": 0})
+        table_stats["hits"] += len(fresh)
+        table_stats["misses"] += len(missing)
+
+        return rows, missing
+
+    def put(
+        self,
+        table: str,
+        fields: Sequence[str],
+        key_field: str,
+        keys: Iterable[str],
+        rows: Iterable[Dict[str, str]],
+    ) -> None:
+        lookup_id = self.lookup_id(table, fields, key_field)
+        rows_by_key: Dict[str, List[Dict[str, str]]] = {k: [] for k in keys}
+        for row in rows:
+            rows_by_key.setdefault(row[key_field], []).append(row)
+
+        fetched_at = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO lookup (lookup_id, key, fetched_at, rows) VALUES (?, ?, ?, ?)",
+                ((lookup_id, key, fetched_at, json.dumps(key_rows)) for key, key_rows in rows_by_key.items()),
+            )
+
+    def close(self) -> None:
+        run_at = time.time()
+        with self.conn:
+            for lookup_id, table_stats in self.stats.items():
+                self.conn.execute(
+                    "INSERT INTO lookup_stats (run_at, lookup_id, hits, misses) VALUES (?, ?, ?, ?)",
+                    (run_at, lookup_id, table_stats["hits"], table_stats["misses"]),
+                )
+                log.info("Cache %s: hits=%d, misses=%d", lookup_id, table_stats["hits"], table_stats["misses"])
+        self.conn.close()
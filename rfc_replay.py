@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, Union
+
+import sap_conn
+from cache_config import RFC_ARCHIVE_PATH
+from log_utils import setup_logger
+
+log = setup_logger("RFC_REPLAY", "rfc_replay.log")
+
+# live   - normal pyrfc connection
+# record - live connection, every call and its response is saved to the archive
+# replay - no SAP at all, calls are answered from the archive
+RFC_MODES = ("live", "record", "replay")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rfc_call (
+    request_key TEXT PRIMARY KEY,
+    system TEXT NOT NULL,
+    func_name TEXT NOT NULL,
+    query_table TEXT,
+    request TEXT NOT NULL,
+    response BLOB NOT NULL,
+    seconds REAL NOT NULL,
+    recorded_at REAL NOT NULL
+);
+"""
+
+
+class RfcArchive:
+    """
+    Recorded RFC calls keyed by system + function + all call parameters (for RFC_READ_TABLE: table, fields,
+    WHERE lines, ROWCOUNT/ROWSKIPS, delimiter). Recording the same request again replaces the older response.
+    """
+
+    def __init__(self, path: Path = RFC_ARCHIVE_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Jedno archiwum dla wszystkich połączeń z puli (każde w swoim wątku)
+        self.conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def request_key(system: str, func_name: str, params: Dict[str, Any]) -> Tuple[str, str]:
+        request = json.dumps({"system": system, "func_name": func_name, "params": params},
+                             sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(request.encode("utf-8")).hexdigest(), request
+
+    def put(self, system: str, func_name: str, params: Dict[str, Any], response: Dict[str, Any], seconds: float) -> None:
+        key, request = self.request_key(system, func_name, params)
+        payload = zlib.compress(json.dumps(response, ensure_ascii=False, default=str).encode("utf-8"), 1)
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO rfc_call "
+                "(request_key, system, func_name, query_table, request, response, seconds, recorded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, system, func_name, params.get("QUERY_TABLE"), request, payload, seconds, time.time()),
+            )
+
+    def get(self, system: str, func_name: str, params: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], float]]:
+        """
+        (response, seconds the live call took) or None if the request was never recorded.
+        """
+        key, _ = self.request_key(system, func_name, params)
+        with self._lock:
+            row = self.conn.execute("SELECT response, seconds FROM rfc_call WHERE request_key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        return json.loads(zlib.decompress(row[0]).decode("utf-8")), row[1]
+
+    def summary(self) -> list:
+        with self._lock:
+            return self.conn.execute(
+                "SELECT system, func_name, query_table, COUNT(*), SUM(seconds), "
+                "datetime(MIN(recorded_at), 'unixepoch', 'localtime'), datetime(MAX(recorded_at), 'unixepoch', 'localtime') "
+                "FROM rfc_call GROUP BY system, func_name, query_table ORDER BY system, query_table"
+            ).fetchall()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def _system_name(params: Dict[str, Any]) -> str:
+    return str(params.get("sysid") or params.get("ashost") or params.get("mshost") or "")
+
+
+class RecordingConnection:
+    """
+    Live pyrfc connection that saves every call with its response to the archive.
+    """
+
+    def __init__(self, conn: Any, archive: RfcArchive, system: str):
+        self.conn = conn
+        self.archive = archive
+        self.system = system
+
+    @property
+    def alive(self) -> bool:
+        return getattr(self.conn, "alive", False)
+
+    def call(self, func_name: str, **params: Any) -> Dict[str, Any]:
+        start = time.perf_counter()
+        response = self.conn.call(func_name, **params)
+        self.archive.put(self.system, func_name, params, response, time.perf_counter() - start)
+        return response
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class ReplayConnection:
+    """
+    Stand-in for pyrfc.Connection answering calls from the archive, without logging on to SAP.
+
+    :param latency: None - answer immediately, "recorded" - wait as long as the live call took,
+                    number - wait that many seconds per call (SAP latency held constant between runs)
+    """
+
+    def __init__(self, archive: RfcArchive, system: str, latency: Union[None, str, float] = None):
+        self.archive = archive
+        self.system = system
+        self.latency = latency
+        self.alive = True
+
+    def call(self, func_name: str, **params: Any) -> Dict[str, Any]:
+        recorded = self.archive.get(self.system, func_name, params)
+        if recorded is None:
+            raise RuntimeError(
+                f"Brak nagrania {func_name} {params.get('QUERY_TABLE', '')} (system={self.system}) "
+                f"w archiwum {self.archive.path} - uruchom raz z --rfc-mode record"
+            )
+
+        response, seconds = recorded
+        delay = seconds if self.latency == "recorded" else (self.latency or 0)
+        if delay:
+            time.sleep(delay)
+        return response
+
+    def close(self) -> None:
+        self.alive = False
+
+
+def parse_replay_latency(value: Optional[str]) -> Union[None, str, float]:
+    if value in (None, "", "0", "none"):
+        return None
+    if value == "recorded":
+        return value
+    return float(value)
+
+
+def set_rfc_mode(mode: str = "live", archive_path: Path = RFC_ARCHIVE_PATH,
+                 replay_latency: Union[None, str, float] = None) -> Optional[RfcArchive]:
+    """
+    Switches every get_conn / get_conn_pool of this process (also in notebook.ipynb) to live, record or replay.
+
+    Returns the opened archive (None for live).
+    """
+    if mode not in RFC_MODES:
+        raise ValueError(f"Unknown RFC mode: {mode!r} (available: {', '.join(RFC_MODES)})")
+
+    if mode == "live":
+        sap_conn.set_connection_factory(None)
+        return None
+
+    archive = RfcArchive(archive_path)
+    if mode == "record":
+        if sap_conn.Connection is None:
+            raise RuntimeError("Brak modułu pyrfc - nagrywanie wymaga połączenia z SAP")
+
+        def factory(**params: Any) -> RecordingConnection:
+            return RecordingConnection(sap_conn.Connection(**params), archive, _system_name(params))
+    else:
+        def factory(**params: Any) -> ReplayConnection:
+            return ReplayConnection(archive, _system_name(params), replay_latency)
+
+    sap_conn.set_connection_factory(factory)
+    log.info("RFC mode: %s (archive %s)", mode, archive.path)
+    return archive
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recorded RFC calls")
+    parser.add_argument('--archive', default=str(RFC_ARCHIVE_PATH))
+    args = parser.parse_args()
+
+    rfc_archive = RfcArchive(Path(args.archive))
+    print(f"{'system':<8}{'function':<18}{'table':<8}{'calls':>7}{'live s':>10}  recorded")
+    for system, func_name, query_table, calls, seconds, first, last in rfc_archive.summary():
+        print(f"{system:<8}{func_name:<18}{query_table or '':<8}{calls:>7}{seconds:>10.1f}  {first} - {last}")
+    rfc_archive.close()
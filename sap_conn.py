@@ -3,22 +3,42 @@
 
 from __future__ import annotations
 
-from contextlib import contextmanager
-from typing import Optional, Dict, Any
-
-from pyrfc import (
-    Connection,
-    CommunicationError,
-    LogonError,
-    ABAPRuntimeError,
-    ABAPApplicationError,
-)
+import queue
+from contextlib import contextmanager, ExitStack
+from typing import Optional, Dict, Any, Iterator, Callable
+
+try:
+    from pyrfc import (
+        Connection,
+        CommunicationError,
+        LogonError,
+        ABAPRuntimeError,
+        ABAPApplicationError,
+    )
+    RFC_ERRORS = (CommunicationError, LogonError, ABAPApplicationError, ABAPRuntimeError)
+except ImportError:
+    # pyrfc (SAP NW RFC SDK) jest potrzebny tylko do prawdziwego połączenia - benchmarki podstawiają własną fabrykę
+    Connection = None
+    RFC_ERRORS = ()
 
 from sap_config import SAP_SYSTEMS, SAP_DEFAULT_SYSTEM
 from log_utils import setup_logger
 
 log = setup_logger("SAP_CONN", "sap_conn.log")
 
+# Called with the connection parameters instead of pyrfc.Connection (see set_connection_factory)
+_connection_factory: Optional[Callable[..., Any]] = None
+
+
+def set_connection_factory(factory: Optional[Callable[..., Any]] = None) -> None:
+    """
+    Replaces pyrfc.Connection for every get_conn / get_conn_pool in this process, e.g. with
+    benchmarks.fake_rfc.FakeRfcConnection. The factory gets the same keyword parameters as pyrfc.Connection.
+    None restores pyrfc.Connection.
+    """
+    global _connection_factory
+    _connection_factory = factory
+
 
 def build_sap_params(system: Optional[str] = None) -> Dict[str, Any]:
     if not SAP_SYSTEMS:
@@ -56,7 +76,10 @@ def get_conn(system: Optional[str] = None) -> Connection:
     system_name = system or SAP_DEFAULT_SYSTEM
 
     try:
-        conn = Connection(**params)
+        factory = _connection_factory or Connection
+        if factory is None:
+            raise RuntimeError("Brak modułu pyrfc - połączenie z SAP niemożliwe")
+        conn = factory(**params)
 
         if 'passwd' in params:
             params['passwd'] = "CLEARED"
@@ -65,7 +88,7 @@ def get_conn(system: Optional[str] = None) -> Connection:
         log.info("Połączenie z SAP nawiązane (system=%s).", system_name)
         yield conn
 
-    except (CommunicationError, LogonError, ABAPApplicationError, ABAPRuntimeError) as e:
+    except RFC_ERRORS as e:
         log.error("Błąd połączenia z SAP (system=%s): %s", system_name, e)
         raise
 
@@ -77,3 +100,18 @@ def get_conn(system: Optional[str] = None) -> Connection:
                     log.info("Połączenie SAP zamknięte (system=%s).", system_name)
             except Exception as e:
                 log.warning("Błąd przy zamykaniu połączenia SAP: %s", e)
+
+
+@contextmanager
+def get_conn_pool(system: Optional[str] = None, size: int = 1) -> Iterator["queue.Queue[Connection]"]:
+    """
+    Opens `size` connections and yields them as a queue - a worker takes a connection with get()
+    and returns it with put(). pyrfc connections must not be shared between threads at the same time.
+    """
+    with ExitStack() as stack:
+        pool: "queue.Queue[Connection]" = queue.Queue()
+        for _ in range(max(1, size)):
+            pool.put(stack.enter_context(get_conn(system)))
+
+        log.info("Pula połączeń SAP gotowa (system=%s, size=%d).", system or SAP_DEFAULT_SYSTEM, pool.qsize())
+        yield pool
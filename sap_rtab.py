@@ -5,8 +5,9 @@ from __future__ import annotations
 import logging 
 import time
 from typing import Dict, List, Tuple, Sequence, Optional, Any
-from pyrfc import Connection, CommunicationError, LogonError, ABAPApplicationError, ABAPRuntimeError
+import pandas as pd
 from log_utils import setup_logger
+from sap_conn import Connection, RFC_ERRORS
 
 log = setup_logger("SAP_RTAB", "sap_rtab.log")
 
@@ -15,13 +16,22 @@ MAX_OPT = 72
 def chunk_list(lst: List[Any], size: int) -> List[List[Any]]:
     return [lst[i : i + size] for i in range(0, len(lst), size)]
 
+def _last_boundary(s: str, max_len: int) -> int:
+    # ostatnia spacja poza literałem '...' - tam można bezpiecznie przełamać linię OPTIONS
+    in_literal = False
+    cut = -1
+    for i, ch in enumerate(s[: max_len + 1]):
+        if ch == "'":
+            in_literal = not in_literal
+        elif ch == " " and not in_literal:
+            cut = i
+    return cut
+
 def split_where(where: str, max_len: int = MAX_OPT) -> List[str]:
     parts: List[str] = []
     s = where.strip()
     while len(s) > max_len:
-        cut_and = s.rfind(" AND ", 0, max_len)
-        cut_or = s.rfind(" OR ", 0, max_len)
-        cut = max(cut_and, cut_or)
+        cut = _last_boundary(s, max_len)
         if cut <= 0:
             parts.append(s[:max_len])
             s = s[max_len:]
@@ -32,24 +42,64 @@ def split_where(where: str, max_len: int = MAX_OPT) -> List[str]:
         parts.append(s)
     return [p for p in parts if p]
 
+def _quote(value: str) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _consecutive_runs(keys: List[str]) -> List[List[str]]:
+    # klucze numeryczne o tej samej długości (np. VBELN z zerami wiodącymi) -> ciągi kolejnych numerów
+    runs: List[List[str]] = []
+    for key in keys:
+        if (
+            runs
+            and key.isdigit()
+            and runs[-1][-1].isdigit()
+            and len(key) == len(runs[-1][-1])
+            and int(key) == int(runs[-1][-1]) + 1
+        ):
+            runs[-1].append(key)
+        else:
+            runs.append([key])
+    return runs
+
+def build_key_where(key_field: str, keys: Sequence[str], min_range: int = 4) -> str:
+    """
+    WHERE for a key lookup: deduplicated keys packed into one IN list, runs of at least
+    min_range consecutive document numbers as BETWEEN ranges.
+    """
+    unique_keys = sorted({str(k) for k in keys}, key=lambda k: (len(k), k))
+    in_list: List[str] = []
+    clauses: List[str] = []
+
+    for run in _consecutive_runs(unique_keys):
+        if len(run) >= min_range:
+            clauses.append(f"{key_field} BETWEEN {_quote(run[0])} AND {_quote(run[-1])}")
+        else:
+            in_list.extend(run)
+
+    if len(in_list) == 1:
+        clauses.insert(0, f"{key_field} = {_quote(in_list[0])}")
+    elif in_list:
+        clauses.insert(0, f"{key_field} IN ( {', '.join(_quote(k) for k in in_list)} )")
+
+    return " OR ".join(clauses)
+
 def options_from_where(where: str) -> List[Dict[str, str]]:
     where = (where or "").strip()
     if not where:
         return []
     return [{"TEXT": ln} for ln in split_where(where)]
 
-def rfc_read_table(
+def _call_read_table(
     conn: Connection,
     table: str,
     fields: Sequence[str],
-    where: str = "",
-    rowcount: int = 0,
-    rowskips: int = 0,
-    delimiter: str = "§",
-) -> List[Dict[str, str]]:
-
+    where: str,
+    rowcount: int,
+    rowskips: int,
+    delimiter: str,
+) -> Dict[str, Any]:
     try:
-        res = conn.call(
+        return conn.call(
             "RFC_READ_TABLE",
             QUERY_TABLE=table,
             DELIMITER=delimiter,
@@ -58,10 +108,22 @@ def rfc_read_table(
             ROWCOUNT=rowcount,
             ROWSKIPS=rowskips,
         )
-    except (CommunicationError, LogonError, ABAPApplicationError, ABAPRuntimeError) as e:
+    except RFC_ERRORS as e:
         log.error("RFC_READ_TABLE error on %s: %s", table, e)
         raise
 
+def rfc_read_table(
+    conn: Connection,
+    table: str,
+    fields: Sequence[str],
+    where: str = "",
+    rowcount: int = 0,
+    rowskips: int = 0,
+    delimiter: str = "§",
+) -> List[Dict[str, str]]:
+
+    res = _call_read_table(conn, table, fields, where, rowcount, rowskips, delimiter)
+
     cols = [f["FIELDNAME"] for f in res.get("FIELDS", [])]
     out: List[Dict[str, str]] = []
     for row in res.get("DATA", []):
@@ -72,3 +134,41 @@ def rfc_read_table(
         out.append({c: p.strip() for c, p in zip(cols, parts)})
     return out
 
+def rfc_read_table_df(
+    conn: Connection,
+    table: str,
+    fields: Sequence[str],
+    where: str = "",
+    rowcount: int = 0,
+    rowskips: int = 0,
+    delimiter: str = "",
+) -> pd.DataFrame:
+    """
+    Columnar variant of rfc_read_table - decodes the WA strings column by column into a DataFrame,
+    without a dict per row.
+
+    delimiter="" (default) reads fixed-width rows and cuts them with the OFFSET/LENGTH returned in FIELDS,
+    so a delimiter character inside a field value can't shift columns.
+    """
+    res = _call_read_table(conn, table, fields, where, rowcount, rowskips, delimiter)
+
+    field_meta = res.get("FIELDS", [])
+    cols = [f["FIELDNAME"] for f in field_meta]
+    wa = pd.Series([row.get("WA", "") for row in res.get("DATA", [])], dtype="string")
+
+    if wa.empty:
+        return pd.DataFrame({c: pd.Series(dtype="string") for c in cols})
+
+    if delimiter:
+        parts = wa.str.split(delimiter, n=len(cols) - 1, expand=True, regex=False)
+        data = {
+            c: (parts[i] if i in parts.columns else pd.Series("", index=wa.index, dtype="string"))
+            for i, c in enumerate(cols)
+        }
+    else:
+        data = {}
+        for f in field_meta:
+            offset = int(f["OFFSET"])
+            data[f["FIELDNAME"]] = wa.str.slice(offset, offset + int(f["LENGTH"]))
+
+    return pd.DataFrame({c: values.fillna("").str.strip() for c, values in data.items()})
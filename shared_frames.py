@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+import pandas as pd
+
+from cache_config import CACHE_DIR
+from log_utils import setup_logger, warn_once
+
+try:
+    import pyarrow as pa
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+log = setup_logger("SHARED_FRAMES", "shared_frames.log")
+
+
+def dump_frame(df: pd.DataFrame, path: Path) -> None:
+    if HAS_PYARROW:
+        # Arrow IPC (Feather v2) bez kompresji - da się go zmapować w pamięci w procesach roboczych
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        warn_once(log, "Brak pyarrow - ramki dla procesów roboczych zapisywane jako pickle zamiast Arrow IPC "
+                       "(pip install -r requirements.txt)")
+        df.to_pickle(path)
+
+
+def load_frame(path: Path) -> pd.DataFrame:
+    # to_pandas kopiuje dane (kolumny tekstowe / kategorie zawsze) - każdy proces ma własną kopię ramki,
+    # mmap oszczędza tylko pickle i bufor odczytu
+    if HAS_PYARROW:
+        with pa.memory_map(str(path), "r") as source:
+            return pa.ipc.open_file(source).read_all().to_pandas()
+
+    return pd.read_pickle(path)
+
+
+@contextmanager
+def shared_frames(frames: Dict[str, Optional[pd.DataFrame]]) -> Iterator[Dict[str, Optional[str]]]:
+    """
+    Writes read-only frames once to uncompressed Arrow files in a local temporary directory and yields
+    name -> file path (None for None frames). Worker processes read the files once with load_frame
+    (initializer), so the frames are not pickled into every task - but each worker still builds its own
+    pandas copy of every frame, memory is not shared between processes. Files are removed on exit.
+
+    Without pyarrow the frames are stored as pickle files.
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="shared_frames_", dir=CACHE_DIR) as tmp_dir:
+        paths: Dict[str, Optional[str]] = {}
+        for name, df in frames.items():
+            if df is None:
+                paths[name] = None
+                continue
+            path = Path(tmp_dir) / f"{name}.arrow"
+            dump_frame(df, path)
+            paths[name] = str(path)
+
+        log.info("Shared frames in %s: %s", tmp_dir, ", ".join(name for name, p in paths.items() if p))
+        yield paths
+
+
+def load_shared_frames(paths: Dict[str, Optional[str]]) -> Dict[str, Optional[pd.DataFrame]]:
+    return {name: None if path is None else load_frame(Path(path)) for name, path in paths.items()}
@@ -1,5 +1,8 @@
 from datetime import date, timedelta
 
+import numpy as np
+import pandas as pd
+
 
 # Python: Monday=0 ... Sunday=6
 TRANSPORT_ROUTES = {
@@ -49,6 +52,51 @@ TRANSPORT_ROUTES = {
 }
 
 
+def _compile_route(route):
+    """
+    Zamienia listę kursów trasy na 7-elementową tablicę: dzień tygodnia daty wysyłki do klienta
+    -> o ile dni cofnąć się do daty załadunku w zakładzie produkcyjnym.
+    """
+    day_offsets = []
+
+    for customer_weekday in range(7):
+        candidates = []
+
+        for leg in route:
+            arrival_day = leg["arrival_day"]
+            ship_day = leg["ship_day"]
+
+            # ile dni cofnąć do ostatniego wystąpienia dnia dostawy
+            days_back = (customer_weekday - arrival_day) % 7
+
+            # obliczenie daty załadunku odpowiadającej tej dostawie
+            transit_days = (arrival_day - ship_day) % 7
+            if transit_days == 0:
+                transit_days = 7
+
+            candidates.append(days_back + transit_days)
+
+        # wybieramy najpóźniejszy możliwy załadunek (najmniejsze cofnięcie)
+        day_offsets.append(min(candidates))
+
+    return tuple(day_offsets)
+
+
+# (zakład produkcyjny, magazyn wysyłkowy) -> przesunięcie w dniach dla każdego dnia tygodnia
+ROUTE_DAY_OFFSETS = {
+    route_key: _compile_route(route)
+    for route_key, route in TRANSPORT_ROUTES.items()
+}
+
+
+def _get_route_day_offsets(production_plant, destination_plant):
+    # Ten sam zakład -> brak transportu
+    if pd.notna(production_plant) and production_plant == destination_plant:
+        return (0,) * 7
+
+    return ROUTE_DAY_OFFSETS.get((production_plant, destination_plant))
+
+
 def get_production_shipping_date(
         customer_ship_date: date,
         production_plant: str,
@@ -66,32 +114,56 @@ def get_production_shipping_date(
     if production_plant == destination_plant:
         return customer_ship_date
 
-    route = TRANSPORT_ROUTES.get((production_plant, destination_plant))
+    day_offsets = ROUTE_DAY_OFFSETS.get((production_plant, destination_plant))
 
-    if route is None:
+    if day_offsets is None:
         raise ValueError(
             f"Brak zdefiniowanej trasy {production_plant} -> {destination_plant}"
         )
 
-    candidates = []
+    return customer_ship_date - timedelta(days=day_offsets[customer_ship_date.weekday()])
+
+
+def get_production_shipping_dates(customer_ship_dates, production_plants, destination_plants):
+    """
+    Wersja tablicowa get_production_shipping_date - przelicza całą kolumnę dat naraz.
+
+    Nie rzuca wyjątku dla pierwszego błędnego wiersza: brakujące daty (NaT) i nieznane trasy
+    dają NaT w wyniku.
+
+    customer_ship_dates - daty wysyłki do klienta (Series / array)
+    production_plants - kody zakładów produkcyjnych
+    destination_plants - kody magazynów wysyłkowych
+
+    Zwraca (daty wysyłki z zakładu produkcyjnego, maska wierszy z nieznaną trasą) - obie jako Series
+    z indeksem customer_ship_dates.
+    """
+    customer_ship_dates = pd.to_datetime(pd.Series(customer_ship_dates))
+    index = customer_ship_dates.index
 
-    for leg in route:
-        arrival_day = leg["arrival_day"]
-        ship_day = leg["ship_day"]
+    routes = pd.MultiIndex.from_arrays([
+        pd.Series(production_plants, index=index).astype(object).to_numpy(),
+        pd.Series(destination_plants, index=index).astype(object).to_numpy(),
+    ])
+    route_codes, unique_routes = pd.factorize(routes)
 
-        # ile dni cofnąć do ostatniego wystąpienia dnia dostawy
-        days_back = (customer_ship_date.weekday() - arrival_day) % 7
+    # Jeden wiersz tablicy przesunięć na każdą występującą trasę (NaN dla nieznanych)
+    offsets_table = np.full((len(unique_routes) + 1, 7), np.nan)
+    for code, (production_plant, destination_plant) in enumerate(unique_routes):
+        day_offsets = _get_route_day_offsets(production_plant, destination_plant)
+        if day_offsets is not None:
+            offsets_table[code] = day_offsets
 
-        arrival_date = customer_ship_date - timedelta(days=days_back)
+    # Kod -1 (brak klucza) wskazuje na ostatni, pusty wiersz tablicy
+    route_codes = np.where(route_codes < 0, len(unique_routes), route_codes)
+    unknown_route = np.isnan(offsets_table[route_codes, 0])
 
-        # obliczenie daty załadunku odpowiadającej tej dostawie
-        transit_days = (arrival_day - ship_day) % 7
-        if transit_days == 0:
-            transit_days = 7
+    weekdays = customer_ship_dates.dt.weekday.to_numpy(dtype=float)
+    has_date = ~np.isnan(weekdays)
 
-        production_ship_date = arrival_date - timedelta(days=transit_days)
+    offsets = np.full(len(customer_ship_dates), np.nan)
+    offsets[has_date] = offsets_table[route_codes[has_date], weekdays[has_date].astype(int)]
 
-        candidates.append(production_ship_date)
+    production_ship_dates = customer_ship_dates - pd.to_timedelta(offsets, unit='D')
 
-    # wybieramy najpóźniejszy możliwy załadunek
-    return max(candidates)
\ No newline at end of file
+    return production_ship_dates, pd.Series(unknown_route, index=index)